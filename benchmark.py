@@ -0,0 +1,1197 @@
+#!/usr/bin/env python3
+"""Benchmarks for the mediawiki_to_git_md scripts.
+
+Run this with the name of a benchmark, for example to compare converting
+MediaWiki files one pandoc call per page against batches of pages::
+
+    $ ./benchmark.py pandoc wiki/
+
+Or to time each stage of converting a generated MediaWiki dump, saving
+the results as JSON for comparison with other versions::
+
+    $ ./benchmark.py suite --pages 1000 -o results.json
+
+Or to compare sorting the revisions using SQLite against xml_to_git.py's
+--external-sort, on a generated dump or a real one::
+
+    $ ./benchmark.py sort --pages 1000
+    $ ./benchmark.py sort --input dump.xml.bz2
+
+The pandoc, fast-path and suite benchmarks need pandoc on the $PATH as for
+mediawiki_to_md.py itself.
+"""
+
+import argparse
+import base64
+import bz2
+import calendar
+import glob
+import difflib
+import gzip
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from xml.sax.saxutils import escape
+
+import mediawiki_to_md
+
+parser = argparse.ArgumentParser(
+    description="Benchmarks for the mediawiki_to_git_md scripts.",
+)
+subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+parser_pandoc = subparsers.add_parser(
+    "pandoc",
+    help="Compare pages per second converting MediaWiki files with one pandoc "
+    "call per page (as by default) against batches of pages.",
+)
+parser_pandoc.add_argument(
+    "input",
+    nargs="+",
+    help="MediaWiki files, or folders of them, as written by xml_to_git.py.",
+)
+parser_pandoc.add_argument(
+    "--batch",
+    default="1,10,25,50",
+    help="Comma separated list of pandoc batch sizes to try, default 1,10,25,50.",
+)
+parser_pandoc.add_argument(
+    "--repeat",
+    type=int,
+    default=1,
+    help="How many times to time each batch size, taking the best, default 1.",
+)
+
+parser_fast = subparsers.add_parser(
+    "fast-path",
+    help="Check the --fast-path conversion gives the same output as pandoc, "
+    "and compare their speed, using MediaWiki files and/or random pages.",
+)
+parser_fast.add_argument(
+    "input",
+    nargs="*",
+    help="MediaWiki files, or folders of them, as written by xml_to_git.py.",
+)
+parser_fast.add_argument(
+    "--random",
+    metavar="N",
+    type=int,
+    default=0,
+    help="Number of random pages mostly using the MediaWiki subset supported "
+    "by the fast path to try, default 0.",
+)
+parser_fast.add_argument(
+    "--seed",
+    type=int,
+    default=1,
+    help="Seed for the random pages, default 1.",
+)
+
+parser_cleanup = subparsers.add_parser(
+    "cleanup",
+    help="Compare the MediaWiki clean up against the original line by line "
+    "version, using MediaWiki files and/or generated pages of increasing size.",
+)
+parser_cleanup.add_argument(
+    "input",
+    nargs="*",
+    help="MediaWiki files, or folders of them, as written by xml_to_git.py.",
+)
+parser_cleanup.add_argument(
+    "--lines",
+    default="100,1000,10000,100000",
+    help="Comma separated list of generated page sizes in lines to try, "
+    "default 100,1000,10000,100000.",
+)
+parser_cleanup.add_argument(
+    "--repeat",
+    type=int,
+    default=3,
+    help="How many times to time each case, taking the best, default 3.",
+)
+
+parser_links = subparsers.add_parser(
+    "links",
+    help="Compare rewriting wikilinks in the Markdown against the original "
+    "version, using generated pages with increasing numbers of links.",
+)
+parser_links.add_argument(
+    "--links",
+    default="100,1000,10000",
+    help="Comma separated list of the number of links per page to try, "
+    "default 100,1000,10000.",
+)
+parser_links.add_argument(
+    "--repeat",
+    type=int,
+    default=3,
+    help="How many times to time each case, taking the best, default 3.",
+)
+
+
+# Settings for the synthetic MediaWiki dumps, shared by generate and suite:
+parser_dump = argparse.ArgumentParser(add_help=False)
+parser_dump.add_argument(
+    "--pages",
+    metavar="N",
+    type=int,
+    default=200,
+    help="Number of pages, default 200.",
+)
+parser_dump.add_argument(
+    "--revisions",
+    metavar="N",
+    type=int,
+    default=5,
+    help="Average number of revisions per page, default 5.",
+)
+parser_dump.add_argument(
+    "--text-size",
+    metavar="CHARS",
+    type=int,
+    default=2000,
+    help="Approximate size of each revision's text in characters, default 2000.",
+)
+parser_dump.add_argument(
+    "--uploads",
+    metavar="N",
+    type=int,
+    default=20,
+    help="Number of uploaded files, default 20.",
+)
+parser_dump.add_argument(
+    "--upload-size",
+    metavar="BYTES",
+    type=int,
+    default=10000,
+    help="Size of each uploaded file in bytes, default 10000.",
+)
+parser_dump.add_argument(
+    "--namespaces",
+    default=",Sub/,Category:,Help:,Talk:",
+    help="Comma separated list of title prefixes, used in turn for the pages, "
+    "default ',Sub/,Category:,Help:,Talk:' (where '' is the main namespace).",
+)
+parser_dump.add_argument(
+    "--users",
+    metavar="N",
+    type=int,
+    default=20,
+    help="Number of (unblocked) users making the edits, default 20.",
+)
+parser_dump.add_argument(
+    "--blocked",
+    metavar="FRACTION",
+    type=float,
+    default=0.05,
+    help="Fraction of revisions made by blocked users (spam), default 0.05.",
+)
+parser_dump.add_argument(
+    "--redirects",
+    metavar="FRACTION",
+    type=float,
+    default=0.05,
+    help="Fraction of pages which are redirects, default 0.05.",
+)
+parser_dump.add_argument(
+    "--seed",
+    type=int,
+    default=1,
+    help="Seed for the random content, default 1.",
+)
+
+parser_generate = subparsers.add_parser(
+    "generate",
+    parents=[parser_dump],
+    help="Write a synthetic MediaWiki XML dump for testing.",
+)
+parser_generate.add_argument(
+    "output",
+    help="Output filename, compressed if ending .gz or .bz2.",
+)
+parser_generate.add_argument(
+    "--blocklist",
+    metavar="FILENAME",
+    help="Optionally write the blocked usernames to this file, "
+    "for use with xml_to_git.py.",
+)
+
+parser_suite = subparsers.add_parser(
+    "suite",
+    parents=[parser_dump],
+    help="Time each stage of converting a synthetic MediaWiki dump, "
+    "writing the results to a JSON file for comparing between versions.",
+)
+parser_suite.add_argument(
+    "-o",
+    "--output",
+    metavar="JSON",
+    default="benchmark.json",
+    help="Output filename for the results, default 'benchmark.json'.",
+)
+parser_suite.add_argument(
+    "--format",
+    choices=["xml", "gz", "bz2"],
+    default="xml",
+    help="Write the dump as plain XML (default), or compressed.",
+)
+parser_suite.add_argument(
+    "--fast-import",
+    action="store_true",
+    help="Run xml_to_git.py with --fast-import.",
+)
+parser_suite.add_argument(
+    "--pandoc-batch",
+    metavar="N",
+    type=int,
+    default=1,
+    help="Pages per pandoc call as in mediawiki_to_md.py, default 1.",
+)
+parser_suite.add_argument(
+    "--fast-path",
+    action="store_true",
+    help="Use the fast path for simple pages as in mediawiki_to_md.py.",
+)
+parser_suite.add_argument(
+    "--no-pandoc",
+    action="store_true",
+    help="Skip the pandoc conversion (and cleanup_markdown) stages.",
+)
+parser_suite.add_argument(
+    "--keep",
+    action="store_true",
+    help="Keep the temporary folder with the dump and git repository.",
+)
+
+
+parser_sort = subparsers.add_parser(
+    "sort",
+    parents=[parser_dump],
+    help="Compare the speed and disk space used by xml_to_git.py sorting the "
+    "revisions with SQLite and with --external-sort, on a synthetic or real "
+    "MediaWiki dump.",
+)
+parser_sort.add_argument(
+    "--input",
+    metavar="XML",
+    help="Real MediaWiki XML dump to use (can be compressed) rather than "
+    "generating one. Used via a link in the temporary folder, so the SQLite "
+    "file is not made next to it.",
+)
+parser_sort.add_argument(
+    "--sort-memory",
+    metavar="MB",
+    type=int,
+    default=256,
+    help="Memory budget for --external-sort, default 256.",
+)
+parser_sort.add_argument(
+    "-o",
+    "--output",
+    metavar="JSON",
+    default="benchmark_sort.json",
+    help="Output filename for the results, default 'benchmark_sort.json'.",
+)
+parser_sort.add_argument(
+    "--keep",
+    action="store_true",
+    help="Keep the temporary folder with the dump and git repositories.",
+)
+
+
+def find_mediawiki_files(inputs):
+    """Return a list of MediaWiki filenames from the given files and folders."""
+    names = []
+    for name in inputs:
+        if os.path.isdir(name):
+            names.extend(
+                sorted(glob.glob(name + "/*." + mediawiki_to_md.mediawiki_ext))
+            )
+        elif os.path.isfile(name):
+            names.append(name)
+        else:
+            sys.exit(f"ERROR: Unexpected input {name}")
+    if not names:
+        sys.exit("ERROR: No MediaWiki files found")
+    return names
+
+
+def benchmark_pandoc(options):
+    """Time converting the pages with pandoc using different batch sizes.
+
+    Checks the Markdown is the same for each batch size.
+    """
+    mediawiki_to_md.pandoc_version = mediawiki_to_md.check_pandoc()
+    # Don't want the cache, or would only be timing that:
+    mediawiki_to_md.pandoc_cache = None
+    names = find_mediawiki_files(options.input)
+    texts = []
+    for mw_filename in names:
+        with open(mw_filename) as handle:
+            texts.append(mediawiki_to_md.cleanup_mediawiki(handle.read())[0])
+    print(
+        "Converting %i pages (%i bytes after cleanup)"
+        % (len(texts), sum(len(_) for _ in texts))
+    )
+
+    expected = None
+    baseline = None
+    for batch in [int(_) for _ in options.batch.split(",")]:
+        mediawiki_to_md.args.pandoc_batch = batch
+        best = None
+        for _ in range(options.repeat):
+            start = time.time()
+            results = mediawiki_to_md.convert_mediawiki(texts, names)
+            taken = time.time() - start
+            best = taken if best is None else min(best, taken)
+        markdown = [_[0] for _ in results]
+        if expected is None:
+            expected = markdown
+            baseline = best
+        elif markdown != expected:
+            sys.exit(f"ERROR: Different output using pandoc batch size {batch}")
+        print(
+            "Batch size %i took %0.2fs, %0.1f pages per second, speed up %0.2fx"
+            % (batch, best, len(texts) / best, baseline / best)
+        )
+
+
+def random_mediawiki(rng):
+    """Return a random page of MediaWiki markup, mostly in the fast path subset.
+
+    Includes things like punctuation which might need escaping, long words,
+    and list markers, which may mean the fast path has to use pandoc.
+    """
+    common = "the quick brown fox jumps over a lazy dog data gene analysis".split()
+    others = "I A x e.g. 1.5 2012 wiki's don't (see) end. it, this; that: why? yes!"
+    others += " 100% a/b a=b C++ user@host a-b +x Dr. 1. - = iv. (a) * # _x a_b"
+    others = others.split()
+    targets = ["Page", "Sub/Page", "Help:Thing 1", "A (b)", "x_y", "C++", "it's"]
+
+    def word():
+        choice = rng.random()
+        word = rng.choice(common if rng.random() < 0.99 else others)
+        if choice < 0.05:
+            return "'''%s'''" % word
+        elif choice < 0.1:
+            return "''%s %s''" % (word, rng.choice(common))
+        elif choice < 0.15:
+            return "[[%s]]" % rng.choice(targets)
+        elif choice < 0.2:
+            return "[[%s|%s]]" % (rng.choice(targets), plain(4))
+        elif choice < 0.23:
+            return "[http://example.org/%s %s]" % (rng.choice("ab"), plain(3))
+        elif choice < 0.24:
+            return "x" * rng.randint(20, 90)
+        return word
+
+    def plain(limit):
+        return " ".join(rng.choice(common) for _ in range(rng.randint(1, limit)))
+
+    def words(limit):
+        return " ".join(word() for _ in range(rng.randint(1, limit)))
+
+    blocks = []
+    for _ in range(rng.randint(1, 6)):
+        choice = rng.random()
+        if choice < 0.15:
+            level = "=" * rng.randint(1, 6)
+            blocks.append("%s %s %s" % (level, words(5), level))
+        elif choice < 0.35:
+            marker = rng.choice("*#")
+            depth = 1
+            items = []
+            for _ in range(rng.randint(1, 12)):
+                depth = max(1, min(depth + rng.choice([-1, 0, 0, 1]), 4))
+                items.append(marker * depth + " " + words(30))
+            blocks.append("\n".join(items))
+        elif choice < 0.45:
+            code = ["x = 1", "  if x:", "", "print('x')"]
+            blocks.append(
+                "<source lang=python>\n%s\n</source>"
+                % "\n".join(rng.choice(code) for _ in range(rng.randint(1, 5)))
+            )
+        else:
+            blocks.append("\n".join(words(50) for _ in range(rng.randint(1, 2))))
+    return rng.choice(["\n\n", "\n"]).join(blocks)
+
+
+def benchmark_fast_path(options):
+    """Compare the fast path against pandoc on the pages it supports.
+
+    This is a differential test of the fast path, so exits with an error
+    if the output differs from pandoc for any page.
+    """
+    mediawiki_to_md.pandoc_version = mediawiki_to_md.check_pandoc()
+    mediawiki_to_md.pandoc_cache = None
+    names = []
+    texts = []
+    if options.input:
+        for mw_filename in find_mediawiki_files(options.input):
+            with open(mw_filename) as handle:
+                names.append(mw_filename)
+                texts.append(mediawiki_to_md.cleanup_mediawiki(handle.read())[0])
+    rng = random.Random(options.seed)
+    for i in range(options.random):
+        names.append("random page %i" % (i + 1))
+        texts.append(random_mediawiki(rng))
+    if not texts:
+        sys.exit("ERROR: Need MediaWiki files and/or --random N")
+
+    start = time.time()
+    fast = [mediawiki_to_md.fast_mediawiki_to_gfm(_) for _ in texts]
+    fast_taken = time.time() - start
+    supported = [i for i, markdown in enumerate(fast) if markdown is not None]
+    print(
+        "Fast path supports %i of %i pages, checking all took %0.1fms, "
+        "%0.1f pages per second"
+        % (len(supported), len(texts), fast_taken * 1000, len(texts) / fast_taken)
+    )
+    if not supported:
+        return
+
+    mediawiki_to_md.args.pandoc_batch = 1
+    start = time.time()
+    slow = mediawiki_to_md.convert_mediawiki(
+        [texts[i] for i in supported], [names[i] for i in supported]
+    )
+    slow_taken = time.time() - start
+    print(
+        "Pandoc took %0.2fs for the supported pages, %0.1f pages per second"
+        % (slow_taken, len(supported) / slow_taken)
+    )
+    different = 0
+    for i, (markdown, warnings, how) in zip(supported, slow):
+        if fast[i] != markdown:
+            different += 1
+            sys.stderr.write("Fast path differs from pandoc for %s\n" % names[i])
+            diff = difflib.unified_diff(
+                markdown.splitlines(True),
+                fast[i].splitlines(True),
+                "pandoc",
+                "fast path",
+            )
+            sys.stderr.write("".join(diff))
+    if different:
+        sys.exit("ERROR: Fast path differs from pandoc for %i pages" % different)
+    print("Fast path matched pandoc for all %i supported pages" % len(supported))
+
+
+def legacy_cleanup_mediawiki(text):
+    """Original line by line version of mediawiki_to_md.cleanup_mediawiki.
+
+    Kept as a reference for the cleanup benchmark, minus the comments.
+    """
+    new = []
+    categories = []
+    languages = mediawiki_to_md.languages
+
+    # This is fragile, but good enough
+    if not text.startswith("---\ntitle: "):
+        sys.exit("ERROR: Missing our title header")
+    text = text[10:].strip()
+    title, text = text.split("\n", 1)
+    assert text.startswith("---\n")
+    text = text[4:]
+
+    for line in text.split("\n"):
+        for lang in languages:
+            if line.lower().startswith("<%s>" % lang):
+                line = (("<source lang=%s\n" % lang) + line[len(lang) + 2 :]).strip()
+            elif line.startswith("<%s " % lang) and ">" in line:
+                line = (("<source lang=%s " % lang) + line[len(lang) + 2 :]).strip()
+            if line.rstrip() == "</%s>" % lang:
+                line = "</source>"
+            elif line.rstrip().endswith("</%s>" % lang):
+                line = line.replace("</%s>" % lang, "\n</source>")
+        undiv = mediawiki_to_md.un_div(line)
+        if undiv in ["__TOC__", "__FORCETOC__", "__NOTOC__"]:
+            continue
+        elif undiv.startswith("[[Image:") and undiv.endswith("]]"):
+            line = undiv
+        while "[[Category:" in line:
+            tag = line[line.index("[[Category:") + 11 :]
+            tag = tag[: tag.index("]]")]
+            assert ("[[Category:%s]]" % tag) in line, "Infered %r from %s" % (tag, line)
+            categories.append(tag)
+            line = line.replace("[[Category:%s]]" % tag, "").strip()
+            if not line:
+                continue
+        if "[[:Category:" in line:
+            line = line.replace("[[:Category:", "[[Category%3A")
+        if "[[User:" in line:
+            line = line.replace("[[User:", "[[User%3A")
+        new.append(line)
+    return "\n".join(new), categories, title
+
+
+def generated_mediawiki(lines, rng):
+    """Return a MediaWiki page with the given number of lines for cleanup.
+
+    Mostly plain text, with some source code tags, categories, magic words
+    and div wrapped images, as handled by the cleanup.
+    """
+    common = "the quick brown fox [[jumps]] over a '''lazy''' dog".split()
+    special = [
+        "<python>",
+        "</python>",
+        "<perl id=example>",
+        "</perl>",
+        "<sql>SELECT * FROM table;</sql>",
+        "__TOC__",
+        '<div style="float:left">[[Image:Pear.png|left|The Bosc Pear]]</div>',
+        "[[Category:Example]]",
+        "See [[:Category:Example]] and [[User:Someone]].",
+        "<ref>A reference</ref> or <br/> tag.",
+    ]
+    text = ["---", "title: Generated page", "---"]
+    for _ in range(lines):
+        if rng.random() < 0.1:
+            text.append(rng.choice(special))
+        else:
+            text.append(" ".join(rng.choice(common) for _ in range(rng.randint(0, 30))))
+    return "\n".join(text)
+
+
+def best_time(function, texts, repeat):
+    """Return the best time in seconds applying the function to all the texts."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in texts:
+            function(text)
+        taken = time.perf_counter() - start
+        best = taken if best is None else min(best, taken)
+    return best
+
+
+def benchmark_cleanup(options):
+    """Time the MediaWiki clean up against the original version.
+
+    Checks the output is the same as the original for every page.
+    """
+    cases = []
+    if options.input:
+        texts = []
+        for mw_filename in find_mediawiki_files(options.input):
+            with open(mw_filename) as handle:
+                texts.append(handle.read())
+        cases.append(("%i files" % len(texts), texts))
+    rng = random.Random(1)
+    for lines in [int(_) for _ in options.lines.split(",")]:
+        cases.append(("%i lines" % lines, [generated_mediawiki(lines, rng)]))
+
+    for name, texts in cases:
+        for text in texts:
+            expected = legacy_cleanup_mediawiki(text)
+            if mediawiki_to_md.cleanup_mediawiki(text) != expected:
+                sys.exit(f"ERROR: Different clean up output for {name}")
+        lines = sum(_.count("\n") + 1 for _ in texts)
+        old = best_time(legacy_cleanup_mediawiki, texts, options.repeat)
+        new = best_time(mediawiki_to_md.cleanup_mediawiki, texts, options.repeat)
+        print(
+            "%s: original %0.2fms (%0.2fus per line), "
+            "now %0.2fms (%0.2fus per line), speed up %0.1fx"
+            % (
+                name,
+                old * 1000,
+                old * 1000000 / lines,
+                new * 1000,
+                new * 1000000 / lines,
+                old / new,
+            )
+        )
+
+
+def legacy_cleanup_markdown(text, source_url):
+    """Original version of mediawiki_to_md.cleanup_markdown.
+
+    Kept as a reference for the links benchmark. This only handled the
+    markdown style links from older versions of pandoc.
+    """
+    prefix = mediawiki_to_md.prefix
+    if prefix:
+        assert prefix.endswith("/") and source_url.startswith(prefix)
+        source = source_url[len(prefix) :]
+        assert not prefix.startswith("/")
+    else:
+        source = source_url
+    if "/" not in source:
+        return text
+    base, page = source.rsplit("/", 1)
+
+    p = re.compile(r']\([A-Z].* "wikilink"\)')
+    for old in p.findall(text):
+        if old.startswith(("](https:", "](http:", "](ftp:", "](mailto:", "])/")):
+            continue
+        new = "](%s" % os.path.relpath(old[2:], base)
+        text = text.replace(old, new)
+    return text
+
+
+def generated_markdown(links, rng, style):
+    """Return Markdown with the given number of wikilinks, one per line.
+
+    The style is "markdown" for links as from older versions of pandoc,
+    or "html" for links as from pandoc 3.
+    """
+    lines = []
+    for i in range(links):
+        target = "%s/Page_%i" % (rng.choice(["Sub", "Other", "Sub/Child"]), i % 500)
+        if style == "markdown":
+            link = '[page %i](%s "wikilink")' % (i, target)
+        else:
+            link = '<a href="%s" class="wikilink" title="page %i">page %i</a>' % (
+                target,
+                i,
+                i,
+            )
+        lines.append("Some text about the %s and more text." % link)
+    return "\n".join(lines) + "\n"
+
+
+def benchmark_links(options):
+    """Time rewriting wikilinks in Markdown against the original version.
+
+    Checks the output is the same as the original on older pandoc style
+    links, then times the pandoc 3 style links with and without an index
+    of the permalinks.
+    """
+    rng = random.Random(1)
+    source_url = mediawiki_to_md.make_url("Sub/Page")
+    permalinks = {}
+    for i in range(500):
+        for name in ("Sub", "Other", "Sub/Child"):
+            title = "%s/Page %i" % (name, i)
+            permalinks[title.replace(" ", "_")] = mediawiki_to_md.make_url(title)
+    for links in [int(_) for _ in options.links.split(",")]:
+        text = generated_markdown(links, rng, "markdown")
+        expected = legacy_cleanup_markdown(text, source_url)
+        if mediawiki_to_md.cleanup_markdown(text, source_url) != expected:
+            sys.exit(f"ERROR: Different output rewriting {links} links")
+        html = generated_markdown(links, rng, "html")
+        times = [
+            best_time(
+                lambda _: legacy_cleanup_markdown(_, source_url),
+                [text],
+                options.repeat,
+            ),
+            best_time(
+                lambda _: mediawiki_to_md.cleanup_markdown(_, source_url),
+                [text],
+                options.repeat,
+            ),
+            best_time(
+                lambda _: mediawiki_to_md.cleanup_markdown(_, source_url),
+                [html],
+                options.repeat,
+            ),
+            best_time(
+                lambda _: mediawiki_to_md.cleanup_markdown(_, source_url, permalinks),
+                [html],
+                options.repeat,
+            ),
+        ]
+        print(
+            "%i links: original %0.2fms, now %0.2fms (speed up %0.1fx), "
+            "pandoc 3 style %0.2fms, with permalinks %0.2fms"
+            % (
+                links,
+                times[0] * 1000,
+                times[1] * 1000,
+                times[0] / times[1],
+                times[2] * 1000,
+                times[3] * 1000,
+            )
+        )
+
+
+def random_wikitext(rng, size, titles):
+    """Return random MediaWiki markup of roughly the given size in characters.
+
+    Built from random_mediawiki pages, plus links to the given page titles
+    and the occasional category, so more like a real page.
+    """
+    blocks = []
+    length = 0
+    while length < size:
+        block = random_mediawiki(rng)
+        if rng.random() < 0.3:
+            block += " See [[%s]]." % rng.choice(titles)
+        if rng.random() < 0.05:
+            block += "\n[[Category:%s]]" % rng.choice(["Example", "Testing", "Other"])
+        blocks.append(block)
+        length += len(block) + 2
+    return "\n\n".join(blocks)
+
+
+def generate_dump(handle, options, rng):
+    """Write a synthetic MediaWiki XML export to the handle (opened as text).
+
+    Returns a dictionary of statistics on what was written, including the
+    list of blocked usernames under "blocked".
+    """
+    users = ["User%i" % (i + 1) for i in range(max(1, options.users))]
+    blocked = ["Spammer%i" % (i + 1) for i in range(3)] if options.blocked else []
+    namespaces = options.namespaces.split(",")
+    titles = []
+    for i in range(options.pages):
+        titles.append("%sPage %i" % (namespaces[i % len(namespaces)], i + 1))
+    # Revisions are written in page order, but want the dates interleaved:
+    start = calendar.timegm((2005, 1, 1, 0, 0, 0))
+    end = start + 3600 * 24 * 365 * 10
+
+    def timestamps(count):
+        return sorted(
+            time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(rng.randint(start, end)))
+            for _ in range(count)
+        )
+
+    def contributor(username):
+        return "<contributor><username>%s</username></contributor>" % username
+
+    stats = {"pages": 0, "revisions": 0, "uploads": 0, "bytes": 0}
+    handle.write(
+        '<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/" '
+        'version="0.10" xml:lang="en">\n'
+        "  <siteinfo>\n    <sitename>Benchmark</sitename>\n  </siteinfo>\n"
+    )
+    for number, title in enumerate(titles):
+        handle.write("  <page>\n    <title>%s</title>\n" % escape(title))
+        count = rng.randint(1, max(1, 2 * options.revisions - 1))
+        redirect = rng.random() < options.redirects
+        text = None
+        for date in timestamps(count):
+            if redirect:
+                text = "#REDIRECT [[%s]]" % rng.choice(titles)
+            elif text is None or rng.random() < 0.2:
+                text = random_wikitext(rng, options.text_size, titles)
+            else:
+                # Typical edit, replacing the end of the page
+                cut = rng.randint(0, len(text))
+                text = text[:cut] + random_wikitext(
+                    rng, max(1, options.text_size - cut), titles
+                )
+            if blocked and rng.random() < options.blocked:
+                username = rng.choice(blocked)
+                content = "Buy stuff at http://spam.example.com/%i" % number
+            else:
+                username = rng.choice(users)
+                content = text
+            handle.write(
+                "    <revision>\n      <timestamp>%s</timestamp>\n      %s\n"
+                "      <comment>Edit by %s</comment>\n"
+                '      <text xml:space="preserve">%s</text>\n    </revision>\n'
+                % (date, contributor(username), username, escape(content))
+            )
+            stats["revisions"] += 1
+            stats["bytes"] += len(content)
+        handle.write("  </page>\n")
+        stats["pages"] += 1
+    for number in range(options.uploads):
+        title = "File:Upload %i.png" % (number + 1)
+        username = rng.choice(users)
+        (date,) = timestamps(1)
+        contents = base64.b64encode(rng.randbytes(options.upload_size)).decode()
+        handle.write(
+            "  <page>\n    <title>%s</title>\n"
+            "    <revision>\n      <timestamp>%s</timestamp>\n      %s\n"
+            '      <text xml:space="preserve">An image.</text>\n    </revision>\n'
+            "    <upload>\n      <timestamp>%s</timestamp>\n      %s\n"
+            "      <comment>Upload</comment>\n      <filename>%s</filename>\n"
+            "      <size>%i</size>\n"
+            '      <contents encoding="base64">%s</contents>\n'
+            "    </upload>\n  </page>\n"
+            % (
+                title,
+                date,
+                contributor(username),
+                date,
+                contributor(username),
+                title[5:].replace(" ", "_"),
+                options.upload_size,
+                contents,
+            )
+        )
+        stats["uploads"] += 1
+        stats["bytes"] += options.upload_size
+    handle.write("</mediawiki>\n")
+    stats["blocked"] = blocked
+    return stats
+
+
+def open_output(filename):
+    """Open the file for writing text, compressing based on the extension."""
+    if filename.endswith(".gz"):
+        return gzip.open(filename, "wt", encoding="utf8")
+    elif filename.endswith(".bz2"):
+        return bz2.open(filename, "wt", encoding="utf8")
+    return open(filename, "w", encoding="utf8")
+
+
+def generate(options):
+    """Write a synthetic MediaWiki XML dump, and optionally the block list."""
+    with open_output(options.output) as handle:
+        stats = generate_dump(handle, options, random.Random(options.seed))
+    print(
+        "Wrote %i pages with %i revisions and %i uploads (%i bytes) to %s"
+        % (
+            stats["pages"],
+            stats["revisions"],
+            stats["uploads"],
+            stats["bytes"],
+            options.output,
+        )
+    )
+    if options.blocklist:
+        with open(options.blocklist, "w") as handle:
+            for username in stats["blocked"]:
+                handle.write(username + "\n")
+
+
+def record_stage(stages, name, seconds, items):
+    """Add timing of a stage to the results, and print it."""
+    stages[name] = {
+        "seconds": round(seconds, 4),
+        "items": items,
+        "per_second": round(items / seconds, 1) if seconds else None,
+    }
+    print(
+        "%-20s %8.2fs %8i items %10.1f per second"
+        % (name, seconds, items, stages[name]["per_second"] or 0)
+    )
+
+
+def benchmark_suite(options):
+    """Time each stage of a conversion of a synthetic dump.
+
+    Generates a dump in a temporary folder, runs xml_to_git.py on it in a new
+    git repository, then times the stages of mediawiki_to_md.py in this
+    process. Writes the results to a JSON file.
+    """
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    cwd = os.getcwd()
+    folder = tempfile.mkdtemp(prefix="mediawiki_benchmark_")
+    repo = os.path.join(folder, "repo")
+    os.mkdir(repo)
+    dump = os.path.join(
+        folder, "dump.xml" + {"xml": ""}.get(options.format, "." + options.format)
+    )
+    stages = {}
+    try:
+        start = time.perf_counter()
+        with open_output(dump) as handle:
+            stats = generate_dump(handle, options, random.Random(options.seed))
+        print(
+            "Generated %i pages with %i revisions and %i uploads in %0.1fs"
+            % (
+                stats["pages"],
+                stats["revisions"],
+                stats["uploads"],
+                time.perf_counter() - start,
+            )
+        )
+        with open(os.path.join(repo, "user_blocklist.txt"), "w") as handle:
+            handle.write("".join(_ + "\n" for _ in stats["blocked"]))
+        for cmd in (
+            ["git", "init", "-q"],
+            ["git", "config", "user.name", "Benchmark"],
+            ["git", "config", "user.email", "benchmark@example.org"],
+        ):
+            subprocess.run(cmd, cwd=repo, check=True)
+
+        cmd = [
+            sys.executable,
+            os.path.join(script_dir, "xml_to_git.py"),
+            "-i",
+            dump,
+            "--stats-json",
+            os.path.join(folder, "stats.json"),
+        ]
+        if options.fast_import:
+            cmd.append("--fast-import")
+        start = time.perf_counter()
+        child = subprocess.run(
+            cmd, cwd=repo, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+        )
+        taken = time.perf_counter() - start
+        if child.returncode:
+            sys.stderr.write(child.stderr)
+            sys.exit("ERROR: xml_to_git.py failed")
+        # Using the stage timings from xml_to_git.py
+        with open(os.path.join(folder, "stats.json")) as handle:
+            times = json.load(handle)["stages"]
+        rows = times["xml_parse"]["count"]
+        record_stage(stages, "parse_xml", times["xml_parse"]["wall_seconds"], rows)
+        record_stage(
+            stages,
+            "sqlite_ingest",
+            times["sqlite_insert"]["wall_seconds"]
+            + times["sqlite_index"]["wall_seconds"],
+            rows,
+        )
+        record_stage(
+            stages,
+            "commit_loop",
+            times["commit_loop"]["wall_seconds"],
+            times["commit_loop"]["count"],
+        )
+        record_stage(stages, "xml_to_git", taken, rows)
+
+        os.chdir(repo)
+        names = sorted(glob.glob("wiki/*." + mediawiki_to_md.mediawiki_ext))
+        start = time.perf_counter()
+        originals = []
+        pages = []
+        for mw_filename in names:
+            with open(mw_filename) as handle:
+                originals.append(handle.read())
+            text, categories, title = mediawiki_to_md.cleanup_mediawiki(originals[-1])
+            if not text.strip().startswith(("#REDIRECT [[", "{{#externalredirect:")):
+                pages.append((mw_filename, text, title))
+        record_stage(stages, "redirect_scan", time.perf_counter() - start, len(names))
+        start = time.perf_counter()
+        for text in originals:
+            mediawiki_to_md.cleanup_mediawiki(text)
+        record_stage(
+            stages, "cleanup_mediawiki", time.perf_counter() - start, len(names)
+        )
+
+        if options.no_pandoc:
+            print("Skipping pandoc and cleanup_markdown")
+        else:
+            mediawiki_to_md.pandoc_version = mediawiki_to_md.check_pandoc()
+            mediawiki_to_md.pandoc_cache = None
+            mediawiki_to_md.args.pandoc_batch = options.pandoc_batch
+            mediawiki_to_md.args.fast_path = options.fast_path
+            start = time.perf_counter()
+            results = mediawiki_to_md.convert_mediawiki(
+                [_[1] for _ in pages], [_[0] for _ in pages]
+            )
+            record_stage(stages, "pandoc", time.perf_counter() - start, len(pages))
+            start = time.perf_counter()
+            for (mw_filename, text, title), (markdown, warnings, how) in zip(
+                pages, results
+            ):
+                mediawiki_to_md.cleanup_markdown(
+                    markdown, mediawiki_to_md.make_url(title)
+                )
+            record_stage(
+                stages, "cleanup_markdown", time.perf_counter() - start, len(pages)
+            )
+    finally:
+        os.chdir(cwd)
+        if options.keep:
+            print(f"Kept files in {folder}")
+        else:
+            shutil.rmtree(folder)
+
+    settings = {
+        _: getattr(options, _)
+        for _ in (
+            "pages",
+            "revisions",
+            "text_size",
+            "uploads",
+            "upload_size",
+            "namespaces",
+            "users",
+            "blocked",
+            "redirects",
+            "seed",
+            "format",
+            "fast_import",
+            "pandoc_batch",
+            "fast_path",
+        )
+    }
+    results = {
+        "date": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "git_commit": subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=script_dir,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).stdout.strip()
+        or None,
+        "python": sys.version.split()[0],
+        "platform": sys.platform,
+        "pandoc": mediawiki_to_md.pandoc_version,
+        "settings": settings,
+        "generated": {_: stats[_] for _ in ("pages", "revisions", "uploads", "bytes")},
+        "stages": stages,
+    }
+    with open(options.output, "w") as handle:
+        json.dump(results, handle, indent=2)
+        handle.write("\n")
+    print(f"Wrote results to {options.output}")
+
+
+# Stages of xml_to_git.py loading the revisions, before the commit loop
+# (not counting decompression, by default done in other threads while
+# parsing):
+ingest_stages = [
+    "xml_copy",
+    "xml_parse",
+    "sqlite_insert",
+    "sqlite_merge",
+    "sqlite_index",
+    "sort_run",
+    "sort",
+]
+
+
+def benchmark_sort(options):
+    """Compare xml_to_git.py using SQLite and --external-sort on the same dump.
+
+    Runs xml_to_git.py with --fast-import in a new git repository for each,
+    recording the time taken to load and sort the revisions and to make the
+    commits, the disk space used (the SQLite file, or the temporary files of
+    sorted runs), and peak memory. Both should give the same git tree.
+    """
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    folder = tempfile.mkdtemp(prefix="mediawiki_benchmark_")
+    blocked = []
+    engines = {}
+    try:
+        if options.input:
+            dump = os.path.join(folder, os.path.basename(options.input))
+            os.symlink(os.path.abspath(options.input), dump)
+            generated = None
+        else:
+            dump = os.path.join(folder, "dump.xml")
+            with open_output(dump) as handle:
+                stats = generate_dump(handle, options, random.Random(options.seed))
+            blocked = stats["blocked"]
+            generated = {
+                _: stats[_] for _ in ("pages", "revisions", "uploads", "bytes")
+            }
+        print("Using %s (%0.1f MB)" % (dump, os.path.getsize(dump) / 1024 / 1024))
+        for engine, extra in (
+            ("sqlite", []),
+            (
+                "external",
+                ["--external-sort", "--sort-memory", str(options.sort_memory)],
+            ),
+        ):
+            repo = os.path.join(folder, engine)
+            os.mkdir(repo)
+            stats_json = os.path.join(folder, engine + ".json")
+            with open(os.path.join(repo, "user_blocklist.txt"), "w") as handle:
+                handle.write("".join(_ + "\n" for _ in blocked))
+            for cmd in (
+                ["git", "init", "-q"],
+                ["git", "config", "user.name", "Benchmark"],
+                ["git", "config", "user.email", "benchmark@example.org"],
+            ):
+                subprocess.run(cmd, cwd=repo, check=True)
+            cmd = [
+                sys.executable,
+                os.path.join(script_dir, "xml_to_git.py"),
+                "-i",
+                dump,
+                "--fast-import",
+                "--stats-json",
+                stats_json,
+            ] + extra
+            start = time.perf_counter()
+            child = subprocess.run(
+                cmd,
+                cwd=repo,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                text=True,
+            )
+            taken = time.perf_counter() - start
+            if child.returncode:
+                sys.stderr.write(child.stderr)
+                sys.exit(f"ERROR: xml_to_git.py failed using {engine}")
+            # Using the stats from xml_to_git.py
+            with open(stats_json) as handle:
+                stats = json.load(handle)
+            times = stats["stages"]
+            if engine == "sqlite":
+                disk = os.path.getsize(dump + ".sqlite")
+                os.remove(dump + ".sqlite")
+            else:
+                disk = stats["counts"]["sort_disk_bytes"]
+            engines[engine] = {
+                "rows": times["xml_parse"]["count"],
+                "ingest_seconds": round(
+                    sum(times[_]["wall_seconds"] for _ in ingest_stages if _ in times),
+                    4,
+                ),
+                "commits": times["commit_loop"]["count"],
+                "commit_seconds": times["commit_loop"]["wall_seconds"],
+                "total_seconds": round(taken, 4),
+                "disk_bytes": disk,
+                "peak_memory": stats["peak_memory"],
+                "tree": subprocess.run(
+                    ["git", "rev-parse", "HEAD^{tree}"],
+                    cwd=repo,
+                    stdout=subprocess.PIPE,
+                    text=True,
+                ).stdout.strip(),
+            }
+    finally:
+        if options.keep:
+            print(f"Kept files in {folder}")
+        else:
+            shutil.rmtree(folder)
+
+    print(
+        "%-10s %10s %10s %10s %10s %10s"
+        % ("Engine", "Ingest", "Commits", "Total", "Disk", "Memory")
+    )
+    for engine, entry in engines.items():
+        print(
+            "%-10s %9.2fs %9.2fs %9.2fs %7.1f MB %10s"
+            % (
+                engine,
+                entry["ingest_seconds"],
+                entry["commit_seconds"],
+                entry["total_seconds"],
+                entry["disk_bytes"] / 1024 / 1024,
+                entry["peak_memory"],
+            )
+        )
+    if engines["sqlite"]["tree"] != engines["external"]["tree"]:
+        sys.exit("ERROR: Using --external-sort gave a different git tree")
+    results = {
+        "date": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": sys.version.split()[0],
+        "platform": sys.platform,
+        "input": options.input,
+        "generated": generated,
+        "sort_memory": options.sort_memory,
+        "engines": engines,
+    }
+    with open(options.output, "w") as handle:
+        json.dump(results, handle, indent=2)
+        handle.write("\n")
+    print(f"Wrote results to {options.output}")
+
+
+if __name__ == "__main__":
+    options = parser.parse_args()
+    if options.benchmark == "pandoc":
+        benchmark_pandoc(options)
+    elif options.benchmark == "fast-path":
+        benchmark_fast_path(options)
+    elif options.benchmark == "cleanup":
+        benchmark_cleanup(options)
+    elif options.benchmark == "links":
+        benchmark_links(options)
+    elif options.benchmark == "generate":
+        generate(options)
+    elif options.benchmark == "suite":
+        benchmark_suite(options)
+    elif options.benchmark == "sort":
+        benchmark_sort(options)
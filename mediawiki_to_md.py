@@ -1,11 +1,32 @@
 #!/usr/bin/env python3
 import argparse
+import concurrent.futures
+import cProfile
+import difflib
+import functools
 import glob
+import hashlib
+import html
+import json
 import os
+import pstats
 import re
+import sqlite3
 import sys
 import subprocess
-import tempfile
+import time
+import uuid
+import zlib
+
+from stage_timing import (
+    add_stage_time,
+    cpu_time,
+    format_seconds,
+    peak_memory,
+    report_stages,
+    stage,
+    stage_times,
+)
 
 # User configurable bits (ought to be command line options?):
 
@@ -13,11 +34,11 @@ debug = False
 
 __version__ = "2.0.2"
 
-if "-v" in sys.argv or "--version" in sys.argv:
+if __name__ == "__main__" and ("-v" in sys.argv or "--version" in sys.argv):
     print("This is mediawiki_to_git_md script mediawiki_to_md version " + __version__)
     sys.exit(0)
 
-if len(sys.argv) == 1:
+if __name__ == "__main__" and len(sys.argv) == 1:
     print("This is mediawiki_to_git_md script mediawiki_to_md version " + __version__)
     print("")
     print("Basic Usage: ./mediawiki_to_md .")
@@ -75,13 +96,115 @@ parser.add_argument(
     default="md",
     help="File extension for MarkDown files, default 'md'.",
 )
+parser.add_argument(
+    "--pandoc-cache",
+    metavar="FOLDER",
+    help="Optional folder to cache the pandoc output in, reused on later runs "
+    "for unchanged pages. Best kept outside the git repository.",
+)
+parser.add_argument(
+    "--pandoc-cache-size",
+    metavar="MB",
+    type=int,
+    default=500,
+    help="Maximum size of the pandoc cache in megabytes, least recently used "
+    "entries are removed at the end of the run. Default 500.",
+)
+parser.add_argument(
+    "-j",
+    "--jobs",
+    metavar="N",
+    type=int,
+    default=1,
+    help="Number of pages to convert in parallel using worker processes, "
+    "default 1. Output and logging is in the same order regardless.",
+)
+parser.add_argument(
+    "--pandoc-batch",
+    metavar="N",
+    type=int,
+    default=1,
+    help="Number of pages to send to each pandoc call, default 1. Larger "
+    "batches avoid the pandoc start up cost for each page.",
+)
+parser.add_argument(
+    "--fast-path",
+    action="store_true",
+    help="Convert simple pages (headings, lists, bold, italic, links, and "
+    "source code) with built in Python code matching pandoc 3's output, "
+    "rather than calling pandoc. Other pages still use pandoc.",
+)
+parser.add_argument(
+    "--check-fast-path",
+    action="store_true",
+    help="Also convert pages the fast path supports with pandoc, and warn "
+    "if the output differs (using pandoc's). For testing the fast path.",
+)
+parser.add_argument(
+    "--memory-limit",
+    metavar="MB",
+    type=int,
+    default=1000,
+    help="Approximate size in megabytes of cleaned up pages to keep in memory "
+    "between reading them and converting them, beyond which they are held "
+    "in a temporary file. Default 1000.",
+)
+parser.add_argument(
+    "--languages",
+    metavar="NAMES",
+    default="python,perl,sql,bash,ruby,java,xml",
+    help="Comma separated list of tags like <python> used on the wiki for "
+    "source code, to be turned into <source lang=python> etc for pandoc. "
+    "Default python,perl,sql,bash,ruby,java,xml.",
+)
+parser.add_argument(
+    "--resolve-links",
+    action="store_true",
+    help="Rewrite internal links to any of the pages being converted (or "
+    "their redirects) to use the page's permalink, relative to the linking "
+    "page. This fixes links to pages with colons in their name.",
+)
+parser.add_argument(
+    "--incremental",
+    metavar="MANIFEST",
+    help="Record the input files and what was converted in this JSON file, "
+    "and on later runs only convert pages which have changed (or which have "
+    "new or removed redirects to them). Best kept outside the git repository.",
+)
+parser.add_argument(
+    "--stats-json",
+    metavar="FILENAME",
+    help="Write the wall and CPU time spent in each stage (reading files, "
+    "clean up, pandoc, post-processing, writing files, etc), rates, and peak "
+    "memory use to this JSON file. With --jobs, the times for the stages "
+    "in the worker processes are added up.",
+)
+parser.add_argument(
+    "--profile",
+    action="store_true",
+    help="Print progress converting pages with an estimated time remaining, "
+    "a table of the time spent in each stage at the end, and the functions "
+    "taking the most time in the main loops (using cProfile, which will "
+    "slow things down, and only covers the main process with --jobs).",
+)
 
 
-args = parser.parse_args()
+if __name__ == "__main__":
+    args = parser.parse_args()
+else:
+    # Imported as a module (e.g. by the worker processes), use the defaults
+    args = parser.parse_args(["--input", "."])
+
+script_start = time.perf_counter()
+script_cpu = time.process_time()
+profiler = cProfile.Profile() if args.profile else None
 
 prefix = args.prefix
 mediawiki_ext = args.mediawiki_ext
 markdown_ext = args.markdown_ext
+pandoc_cache = args.pandoc_cache
+pandoc_cache_size = args.pandoc_cache_size
+languages = [_.strip().lower() for _ in args.languages.split(",") if _.strip()]
 
 # Do these need to be configurable?:
 page_prefixes_to_ignore = [
@@ -94,6 +217,8 @@ page_prefixes_to_ignore = [
 default_layout = "wiki"  # Can also use None; note get tagpage for category listings
 git = "git"  # assume on path
 pandoc = "pandoc"  # assume on path
+pandoc_from = "mediawiki"
+pandoc_to = "gfm-hard_line_breaks"  # was "markdown_github-hard_line_breaks"
 
 
 def check_pandoc():
@@ -114,20 +239,37 @@ def check_pandoc():
     for line in stdout.split("\n"):
         if line.startswith("pandoc ") and "." in line:
             print("Will be using " + line)
+            return line
+    return stdout
 
 
-check_pandoc()
+pandoc_version = None
+if __name__ == "__main__":
+    pandoc_version = check_pandoc()
+    if args.fast_path and not pandoc_version.startswith("pandoc 3."):
+        sys.stderr.write(
+            "WARNING - The fast path matches the output of pandoc 3, "
+            "which will differ from %s\n" % pandoc_version
+        )
 
 
 missing_users = dict()
 unwanted_commits = 0
 
+# Filled in by the redirect scan, mapping filenames to redirect targets,
+# and page titles to a list of the titles which redirect to it:
+redirects = {}
+redirects_from = {}
+# Filled in with --resolve-links, mapping page names to their permalinks:
+permalinks = {}
 
-assert os.path.isdir(".git"), "Expected to be in a Git repository!"
-if prefix:
-    assert prefix.endswith("/")
-    if not os.path.isdir(prefix):
-        os.mkdir(prefix)
+
+if __name__ == "__main__":
+    assert os.path.isdir(".git"), "Expected to be in a Git repository!"
+    if prefix:
+        assert prefix.endswith("/")
+        if not os.path.isdir(prefix):
+            os.mkdir(prefix)
 
 
 def un_div(text):
@@ -144,6 +286,75 @@ assert un_div(tmp) == "[[Image:Pear.png|left|The Bosc Pear]]", un_div(tmp)
 del tmp
 
 
+def cleanup_patterns(languages):
+    """Compile the regular expressions used by cleanup_mediawiki.
+
+    Returns a tuple of patterns for lines which may need changing, opening
+    source code tags, and closing source code tags. Cached per language list.
+    """
+    if languages not in _cleanup_patterns:
+        names = "|".join(re.escape(_) for _ in languages) or "(?!)"
+        _cleanup_patterns[languages] = (
+            re.compile(
+                r"^(?:[^\S\n]*<|__(?:NO|FORCE)?TOC__$"
+                r"|.*?(?:\[\[(?::?Category|User):|</(?:%s)>[^\S\n]*$)).*" % names,
+                re.MULTILINE,
+            ),
+            # Easy case <python> etc (any case), or <python id=example> etc
+            re.compile(r"<(?:(?i:(%s))>|(%s) .*>)" % (names, names)),
+            re.compile(r"</(%s)>$" % names),
+        )
+    return _cleanup_patterns[languages]
+
+
+_cleanup_patterns = {}
+
+
+def cleanup_line(line, categories, patterns):
+    """Clean up a single line of mediawiki markup for cleanup_mediawiki.
+
+    Any categories are removed from the line and added to the list.
+    Returns the new line (which may now be several lines), or None to drop it.
+    """
+    lines, opening, closing = patterns
+    match = opening.match(line)
+    if match and match.group(1):
+        lang = match.group(1).lower()
+        line = (("<source lang=%s\n" % lang) + line[len(lang) + 2 :]).strip()
+    elif match:
+        lang = match.group(2)
+        line = (("<source lang=%s " % lang) + line[len(lang) + 2 :]).strip()
+    # Want to support <python>print("Hello world")</python>
+    # where open and closing tags are on the same line:
+    match = closing.search(line.rstrip())
+    if match and match.start() == 0:
+        line = "</source>"
+    elif match:
+        line = line.replace(match.group(), "\n</source>")
+    undiv = un_div(line)
+    if undiv in ["__TOC__", "__FORCETOC__", "__NOTOC__"]:
+        return None
+    elif undiv.startswith("[[Image:") and undiv.endswith("]]"):
+        # Markdown image wrapped in a div does not render on Github Pages,
+        # remove the div and any attempt at styling it (e.g. alignment)
+        line = undiv
+    # Look for any category tag, usually done as a single line:
+    while "[[Category:" in line:
+        tag = line[line.index("[[Category:") + 11 :]
+        if "]]" not in tag:
+            break
+        tag = tag[: tag.index("]]")]
+        categories.append(tag)
+        line = line.replace("[[Category:%s]]" % tag, "").strip()
+    # Special case fix for any category links,
+    # See https://github.com/jgm/pandoc/issues/2849
+    if "[[:Category:" in line:
+        line = line.replace("[[:Category:", "[[Category%3A")
+    if "[[User:" in line:
+        line = line.replace("[[User:", "[[User%3A")
+    return line
+
+
 def cleanup_mediawiki(text):
     """Modify mediawiki markup to make it pandoc ready.
 
@@ -170,7 +381,7 @@ def cleanup_mediawiki(text):
     # import antigravity
     # ```
     #
-    # Which is much nicer.
+    # Which is much nicer. The tags handled are set via --languages.
     #
     # =================================================
     #
@@ -181,9 +392,14 @@ def cleanup_mediawiki(text):
     # Meanwhile the MediaWiki __TOC__ etc get left in the .md
     # so I'm just going to remove them here.
     #
+    # =================================================
+    #
+    # This is done in a single sweep over the text, finding only the lines
+    # which might need changing with one precompiled regular expression,
+    # and copying everything in between unchanged.
     new = []
     categories = []
-    languages = ["python", "perl", "sql", "bash", "ruby", "java", "xml"]
+    patterns = cleanup_patterns(tuple(languages))
 
     # This is fragile, but good enough
     if not text.startswith("---\ntitle: "):
@@ -193,47 +409,21 @@ def cleanup_mediawiki(text):
     assert text.startswith("---\n")
     text = text[4:]
 
-    for line in text.split("\n"):
-        # line is already unicode
-        # TODO - line = line.replace("\xe2\x80\x8e".decode("utf-8"), "")  # LEFT-TO-RIGHT
-        # TODO - Would benefit from state tracking (for tag mismatches)
-        for lang in languages:
-            # Easy case <python> etc
-            if line.lower().startswith("<%s>" % lang):
-                line = (("<source lang=%s\n" % lang) + line[len(lang) + 2 :]).strip()
-            # Also cope with <python id=example> etc:
-            elif line.startswith("<%s " % lang) and ">" in line:
-                line = (("<source lang=%s " % lang) + line[len(lang) + 2 :]).strip()
-            # Want to support <python>print("Hello world")</python>
-            # where open and closing tags are on the same line:
-            if line.rstrip() == "</%s>" % lang:
-                line = "</source>"
-            elif line.rstrip().endswith("</%s>" % lang):
-                line = line.replace("</%s>" % lang, "\n</source>")
-        undiv = un_div(line)
-        if undiv in ["__TOC__", "__FORCETOC__", "__NOTOC__"]:
-            continue
-        elif undiv.startswith("[[Image:") and undiv.endswith("]]"):
-            # Markdown image wrapped in a div does not render on Github Pages,
-            # remove the div and any attempt at styling it (e.g. alignment)
-            line = undiv
-        # Look for any category tag, usually done as a single line:
-        while "[[Category:" in line:
-            tag = line[line.index("[[Category:") + 11 :]
-            tag = tag[: tag.index("]]")]
-            assert ("[[Category:%s]]" % tag) in line, "Infered %r from %s" % (tag, line)
-            categories.append(tag)
-            line = line.replace("[[Category:%s]]" % tag, "").strip()
-            if not line:
-                continue
-        # Special case fix for any category links,
-        # See https://github.com/jgm/pandoc/issues/2849
-        if "[[:Category:" in line:
-            line = line.replace("[[:Category:", "[[Category%3A")
-        if "[[User:" in line:
-            line = line.replace("[[User:", "[[User%3A")
-        new.append(line)
-    return "\n".join(new), categories, title
+    start = 0
+    for match in patterns[0].finditer(text):
+        new.append(text[start : match.start()])
+        start = match.end()
+        line = cleanup_line(match.group(), categories, patterns)
+        if line is not None:
+            new.append(line)
+        elif start < len(text):
+            # Drop the line break after the removed line too
+            start += 1
+        else:
+            # Removed the last line, so drop the line break before it
+            new = ["".join(new)[:-1]]
+    new.append(text[start:])
+    return "".join(new), categories, title
 
 
 tmp = """\
@@ -250,13 +440,44 @@ assert cleanup_mediawiki(tmp) == (
 del tmp
 
 
-def cleanup_markdown(text, source_url):
+def make_cannonical(title):
+    """Spaces to underscore; first letter upper case only."""
+    # Cannot use .title(), e.g. 'Biopython small.jpg' --> 'Biopython Small.Jpg'
+    title = title.replace(" ", "_")
+    return title[0].upper() + title[1:].lower()
+
+
+def make_url(title):
+    """Spaces to underscore; adds prefix; no trailing slash."""
+    return os.path.join(prefix, title.replace(" ", "_").replace(":", "%3A"))
+
+
+# Internal links from pandoc, either ...](URL "wikilink")... from older
+# versions, or <a href="URL" class="wikilink" ...> from pandoc 3, where
+# the URL should look like a relative link (no http etc)
+wikilink_pattern = re.compile(
+    r'(\]\()([A-Z][^"\n]*?)( "wikilink"\))'
+    r'|(<a href=")([^"/#][^"]*)(" class="wikilink")'
+)
+
+
+@functools.lru_cache(maxsize=100000)
+def relative_link(target, base):
+    """Return os.path.relpath(target, base), remembering previous results."""
+    return os.path.relpath(target, base)
+
+
+def cleanup_markdown(text, source_url, permalinks=None):
     """Post-process markdown from pandoc before saving it.
 
     Currently only want to tweak internal wikilinks which point at
     at (or are from) pages using child namespaces with slashes in them.
     Problem is MediaWiki treats them as absolute (from base path),
     while Jekyll will treat them as relative (to the current path).
+
+    Optional argument permalinks is a dictionary of page names (as in
+    the wikilinks, with underscores) to their URL from make_url, used
+    to rewrite links to those pages relative to this page.
     """
     if prefix:
         assert prefix.endswith("/") and source_url.startswith(prefix)
@@ -264,32 +485,69 @@ def cleanup_markdown(text, source_url):
         assert not prefix.startswith("/")
     else:
         source = source_url
-    if "/" not in source:
+    if "/" not in source and not permalinks:
         return text
-    base, page = source.rsplit("/", 1)
-
-    # Looking for ...](URL "wikilink")... where the URL should look
-    # like a relative link (no http etc)
-    p = re.compile(']\([A-Z].* "wikilink"\)')
-    for old in p.findall(text):
-        if old.startswith(("](https:", "](http:", "](ftp:", "](mailto:", "])/")):
-            continue
-        new = "](%s" % os.path.relpath(old[2:], base)
-        # print("Replacing %s --> %s" % (old[1:], new[1:]))
-        text = text.replace(old, new)
-    return text
-
-
-def make_cannonical(title):
-    """Spaces to underscore; first letter upper case only."""
-    # Cannot use .title(), e.g. 'Biopython small.jpg' --> 'Biopython Small.Jpg'
-    title = title.replace(" ", "_")
-    return title[0].upper() + title[1:].lower()
-
+    base = source.rsplit("/", 1)[0] if "/" in source else None
+    folder = os.path.dirname(source_url) or "."
 
-def make_url(title):
-    """Spaces to underscore; adds prefix; no trailing slash."""
-    return os.path.join(prefix, title.replace(" ", "_").replace(":", "%3A"))
+    def rewrite(match):
+        if match.group(1):
+            start, target, end = match.group(1, 2, 3)
+        else:
+            start, target, end = match.group(4, 5, 6)
+            if "://" in target or target.startswith("mailto:"):
+                return match.group()
+        if permalinks:
+            page, sep, anchor = target.partition("#")
+            page = html.unescape(page)
+            url = permalinks.get(page[:1].upper() + page[1:])
+            if url:
+                url = relative_link(url, folder) + sep + anchor
+                if match.group(4):
+                    url = html.escape(url).replace("&#x27;", "&#39;")
+                return start + url + end
+        if base is None:
+            return match.group()
+        return start + relative_link(target, base) + end
+
+    return wikilink_pattern.sub(rewrite, text)
+
+
+# Targets of the [[...]] links in MediaWiki markup, before any | or ]]:
+mediawiki_link_pattern = re.compile(r"\[\[([^\[\]|]*)")
+
+
+def linked_pages(text):
+    """Return sorted list of the page names linked to from MediaWiki markup.
+
+    These are in the form used as keys for the permalinks with cleanup_markdown
+    (underscores, first letter upper case), so with --resolve-links only these
+    permalinks matter for the converted page.
+    """
+    pages = set()
+    for target in mediawiki_link_pattern.findall(text):
+        page = target.strip().replace(" ", "_").partition("#")[0]
+        if page:
+            pages.add(page[:1].upper() + page[1:])
+    return sorted(pages)
+
+
+tmp = "See [[Sub/Child page|child]], [[main Page#Top]] and [[#Local]]."
+assert linked_pages(tmp) == ["Main_Page", "Sub/Child_page"], linked_pages(tmp)
+
+
+tmp = 'See [child](Sub/Child "wikilink") and <a href="Sub/Other_page" class="wikilink"'
+assert cleanup_markdown(tmp, prefix + "Sub/Page") == (
+    'See [child](Child "wikilink") and <a href="Other_page" class="wikilink"'
+), cleanup_markdown(tmp, prefix + "Sub/Page")
+assert cleanup_markdown(tmp, prefix + "Page") == tmp
+tmp = '<a href="Help:Using_it#Start" class="wikilink"'
+assert cleanup_markdown(
+    tmp, prefix + "Sub/Page", {"Help:Using_it": make_url("Help:Using it")}
+) == ('<a href="../Help%3AUsing_it#Start" class="wikilink"'), cleanup_markdown(
+    tmp, prefix + "Sub/Page", {"Help:Using_it": make_url("Help:Using it")}
+)
+del tmp
 
 
 def make_filename(title, ext):
@@ -349,35 +607,790 @@ def commit_file(title, filename, date, username, contents, comment):
     commit_files([filename], username, date, comment)
 
 
-names = []
-for name in args.input:
-    if name.startswith("../"):
+# The fast path mimics the output of pandoc 3 with pandoc_to for a simple
+# subset of MediaWiki markup, and returns None for anything else. It is
+# deliberately cautious: paragraphs, headings, lists using only * or only #,
+# bold, italic, wikilinks, external links, and <source lang=...> blocks,
+# using ASCII text without characters Markdown might need escaped.
+fast_path_word = re.compile(r"[A-Za-z0-9,.;:!?\"%()/=+@-]+$")
+fast_path_label = re.compile(
+    r"[A-Za-z0-9,.;:!?%()/=+@'-]+( [A-Za-z0-9,.;:!?%()/=+@'-]+)*$"
+)
+fast_path_target = re.compile(
+    r"[A-Za-z0-9][A-Za-z0-9_/:.,()+'-]*( [A-Za-z0-9_/:.,()+'-]+)*$"
+)
+fast_path_url = re.compile(r"(https?|ftp)://[A-Za-z0-9/._~:?=&%#+,;@-]+$")
+fast_path_inline = re.compile(
+    r"\[\[([^\[\]]*)\]\]|\[([^\s\[\]]+) ([^\[\]]*)\]|'+| +|[^\s'\[\]]+"
+)
+fast_path_heading = re.compile(r"(={1,6})([^=]+)(={1,6}) *$")
+fast_path_source = re.compile(
+    r'<(source|syntaxhighlight) lang=("?)([A-Za-z0-9_+-]+)\2>$'
+)
+fast_path_width = 72
+
+
+def fast_path_words(line):
+    """Convert a line of MediaWiki text for the fast path.
+
+    Returns Markdown with NUL characters where the line may be wrapped,
+    or None if outside the supported subset.
+    """
+    for token in line.split():
+        if not re.search("[A-Za-z0-9]", token) or re.match(r"[0-9]+[.)]$", token):
+            # Might be read as a list item, heading, or similar if wrapped
+            # onto the start of a line, so pandoc would escape it.
+            return None
+    words = []
+    emphasis = None
+    end = 0
+    for match in fast_path_inline.finditer(line):
+        if match.start() != end:
+            return None
+        end = match.end()
+        token = match.group(0)
+        if match.group(1) is not None:
+            # [[target]] or [[target|label]]
+            target, _, label = match.group(1).partition("|")
+            label = label or target
+            if (
+                not fast_path_target.match(target)
+                or not fast_path_label.match(label)
+                or "''" in label
+                or target.split(":", 1)[0].lower()
+                in ("category", "file", "image", "media")
+                or line[end : end + 1].isalnum()
+            ):
+                # Note pandoc would include any trailing letters in the label
+                return None
+            # Pandoc renders these via its HTML writer, wrapping them on
+            # their own, which are then kept as a block of lines:
+            title = label.replace("'", "&#39;")
+            label = label.split(" ")
+            label[0] = 'title="%s">%s' % (title, label[0])
+            label[-1] += "</a>"
+            href = target.replace(" ", "_").replace("'", "&#39;")
+            html = ["<a", 'href="%s"' % href, 'class="wikilink"']
+            words.append(fast_path_wrap("\0".join(html + label)))
+        elif match.group(2) is not None:
+            # [url label]
+            if (
+                not fast_path_url.match(match.group(2))
+                or not fast_path_label.match(match.group(3))
+                or "''" in match.group(3)
+            ):
+                return None
+            words.append(
+                "[%s](%s)" % (match.group(3).replace(" ", "\0"), match.group(2))
+            )
+        elif token.startswith("'"):
+            if token == "'":
+                words.append(token)
+                continue
+            if len(token) not in (2, 3) or emphasis not in (None, token):
+                return None
+            if emphasis is None:
+                # Opening, must be followed by a letter or digit
+                if not line[end : end + 1].isalnum():
+                    return None
+                emphasis = token
+            else:
+                # Closing, must follow a letter or digit (or punctuation if
+                # followed by a space)
+                if not line[match.start() - 1].isalnum() and (
+                    line[match.start() - 1] not in ".,;:!?"
+                    or line[end : end + 1] not in ("", " ")
+                ):
+                    return None
+                emphasis = None
+            words.append("*" * (len(token) - 1))
+        elif token.startswith(" "):
+            words.append("\0")
+        elif fast_path_word.match(token) and "://" not in token:
+            words.append(token)
+        else:
+            return None
+    if end != len(line) or emphasis:
+        return None
+    return "".join(words)
+
+
+def fast_path_wrap(words, marker="", indent=0):
+    """Wrap the output of fast_path_words like pandoc, as list item if marker.
+
+    Words may contain line breaks (from wikilinks), in which case only their
+    first line must fit onto the current line.
+    """
+    lines = [""]
+    for word in words.split("\0"):
+        word = word.split("\n")
+        if not lines[-1]:
+            pass
+        elif indent + len(lines[-1]) + 1 + len(word[0]) > fast_path_width:
+            lines.append("")
+        else:
+            lines[-1] += " "
+        lines[-1] += word[0]
+        lines.extend(word[1:])
+    return (" " * (indent - len(marker)) + marker) + ("\n" + " " * indent).join(lines)
+
+
+def fast_mediawiki_to_gfm(text):
+    """Convert simple cleaned up MediaWiki text to Markdown without pandoc.
+
+    Returns the same Markdown as pandoc would, or None if the text uses
+    anything beyond the simple subset of MediaWiki markup supported.
+    """
+    if not text.isascii() or "\t" in text or "\r" in text:
+        return None
+    blocks = []
+    paragraph = []
+    items = []
+    list_end = None
+    lines = iter(text.split("\n") + [""])
+    for line in lines:
+        if paragraph and (not line.strip() or line[0] in "=*#<"):
+            words = fast_path_words(" ".join(paragraph))
+            if words is None or words.split("\0", 1)[0].endswith((".", ")")):
+                # e.g. pandoc would escape "A." or "iv)" starting a paragraph
+                return None
+            blocks.append(fast_path_wrap(words))
+            paragraph = []
+        if items and (not line.strip() or line[0] != items[0][0][0]):
+            # End of list
+            if list_end == len(blocks):
+                # Consecutive lists, pandoc would separate with <!-- -->
+                return None
+            depth = 0
+            numbers = []
+            markdown = []
+            for prefix, words in items:
+                if len(prefix) > depth + 1:
+                    return None
+                depth = len(prefix)
+                numbers = numbers[:depth] + [0] * (depth - len(numbers))
+                numbers[-1] += 1
+                if prefix[0] == "*":
+                    markdown.append(fast_path_wrap(words, "- ", 2 * depth))
+                elif numbers[-1] < 100:
+                    # Pandoc pads the numbers to four characters
+                    marker = "%-4s" % ("%i." % numbers[-1])
+                    markdown.append(fast_path_wrap(words, marker, 4 * depth))
+                else:
+                    return None
+            # Lists are tight, so no blank line between items
+            blocks.append("\n".join(markdown))
+            list_end = len(blocks)
+            items = []
+        line = line.rstrip()
+        if not line:
+            continue
+        elif line[0] in "*#":
+            prefix = line[: len(line) - len(line.lstrip("*#"))]
+            if prefix.strip(prefix[0]) or (items and prefix[0] != items[0][0][0]):
+                # Mixed list types like #* or *#, or * then # lists
+                return None
+            words = fast_path_words(line[len(prefix) :].strip())
+            if not words or words.split("\0", 1)[0].endswith((".", ")")):
+                return None
+            items.append((prefix, words))
+        elif line[0] == "=":
+            match = fast_path_heading.match(line)
+            if not match or len(match.group(1)) != len(match.group(3)):
+                return None
+            words = fast_path_words(match.group(2).strip())
+            if not words or words.split("\0", 1)[0].endswith((".", ")")):
+                return None
+            blocks.append("#" * len(match.group(1)) + " " + words.replace("\0", " "))
+        elif line[0] == "<":
+            match = fast_path_source.match(line)
+            if not match:
+                return None
+            code = []
+            for line in lines:
+                if line == "</%s>" % match.group(1):
+                    break
+                if "`" in line or "</%s" % match.group(1) in line.lower():
+                    return None
+                code.append(line)
+            else:
+                # Missing closing tag
+                return None
+            while code and not code[-1]:
+                code.pop()
+            if not code or not code[-1].strip():
+                return None
+            blocks.append("``` %s\n%s\n```" % (match.group(3), "\n".join(code)))
+        elif line[0].isalnum() or line.startswith(("''", "[")):
+            paragraph.append(line)
+        else:
+            return None
+    if not blocks:
+        return None
+    return "\n\n".join(blocks) + "\n"
+
+
+tmp = """\
+== Example ==
+Some '''bold''' and ''italic'' text with a [[Sub/Page|child page]] and
+an [http://example.org external link].
+
+* One
+** Two
+<source lang=python>
+print('Hello')
+</source>"""
+assert fast_mediawiki_to_gfm(tmp) == (
+    "## Example\n\n"
+    "Some **bold** and *italic* text with a\n"
+    '<a href="Sub/Page" class="wikilink" title="child page">child page</a>\n'
+    "and an [external link](http://example.org).\n\n"
+    "- One\n  - Two\n\n"
+    "``` python\nprint('Hello')\n```\n"
+), fast_mediawiki_to_gfm(tmp)
+assert fast_mediawiki_to_gfm("{| class=wikitable\n|}") is None
+del tmp
+
+
+def run_pandoc(text, mw_filename):
+    """Convert cleaned up MediaWiki text to Markdown using pandoc.
+
+    Returns the Markdown and any warnings from pandoc.
+    """
+    child = subprocess.run(
+        [pandoc, "-f", pandoc_from, "-t", pandoc_to],
+        input=text,
+        text=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    stdout = child.stdout
+    stderr = child.stderr
+
+    # What did pandoc think? Any warnings are returned to the caller,
+    # as with --jobs this may be running in a worker process.
+    if child.returncode:
         sys.exit(
-            f"ERROR: Input files must be within the current directory and git repo"
+            "ERROR - Calling pandoc failed, error %i for %r:\n%s"
+            % (child.returncode, mw_filename, stderr)
         )
-    if os.path.isdir(name):
-        names.extend(glob.glob(name + "/*." + mediawiki_ext))
-    elif os.path.isfile(name) and name.endswith("." + mediawiki_ext):
-        names.append(name)
-    else:
-        sys.exit(f"ERROR: Unexpected input {name}")
-print(f"Have {len(names)} input MediaWiki files")
+    if not stdout:
+        sys.exit("ERROR - Calling pandoc failed, no output for %r" % mw_filename)
+    return stdout, stderr
 
-print("Checking for redirects...")
-redirects = {}
-redirects_from = {}
-for mw_filename in names:
-    with open(mw_filename) as handle:
-        original = handle.read()
 
-    assert original.startswith("---\ntitle: "), mw_filename
-    text, categories, title = cleanup_mediawiki(original)
+def run_pandoc_batch(texts, mw_filenames):
+    """Convert several cleaned up MediaWiki texts using a single pandoc call.
+
+    The pages are joined using a unique separator paragraph, and the output
+    split on it again. Returns a list of (Markdown, warnings) tuples.
 
-    if text.strip().startswith("#REDIRECT [[") and text.strip().endswith("]]"):
-        # Internal redirect, will become a redirect_from entry in target page
-        redirect = text.strip()[12:-2]
+    Pages using <ref> footnotes are converted on their own, as pandoc would
+    collect the notes at the end of the combined document. If pandoc gives
+    any warnings, or the separators do not come back as expected (e.g. a page
+    with an unclosed table or tag swallowed one), the pages are converted
+    one by one instead, so the results are exactly as without batching.
+    """
+    results = [None] * len(texts)
+    batch = []
+    for i, text in enumerate(texts):
+        if len(texts) == 1 or "<ref" in text.lower():
+            results[i] = run_pandoc(text, mw_filenames[i])
+        else:
+            batch.append(i)
+    if not batch:
+        return results
+
+    separator = "MWTOMDBATCH%sX" % uuid.uuid4().hex
+    combined = []
+    for n, i in enumerate(batch):
+        if n:
+            combined.append("\n\n%s%i\n\n" % (separator, n))
+        combined.append(texts[i])
+    child = subprocess.run(
+        [pandoc, "-f", pandoc_from, "-t", pandoc_to],
+        input="".join(combined),
+        text=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    parts = re.split("^%s([0-9]+)\n\n" % separator, child.stdout, flags=re.MULTILINE)
+    if (
+        child.returncode
+        or child.stderr
+        or parts[1::2] != [str(n) for n in range(1, len(batch))]
+        or not all(_.endswith("\n\n") for _ in parts[0:-1:2])
+        or not all(parts[::2])
+    ):
+        for i in batch:
+            results[i] = run_pandoc(texts[i], mw_filenames[i])
+        return results
+    for n, i in enumerate(batch):
+        # Remove the blank line pandoc puts before the separator paragraph:
+        results[i] = (parts[2 * n] if n + 1 == len(batch) else parts[2 * n][:-1], "")
+    return results
+
+
+converted_by = {"fast": 0, "cached": 0, "pandoc": 0, "different": 0}
+
+
+def pandoc_cache_filename(text):
+    """Return the pandoc cache filename for this cleaned up MediaWiki text.
+
+    The cache key is a checksum of the pandoc version, the formats used,
+    and the cleaned up text.
+    """
+    key = hashlib.sha1(
+        "\0".join([pandoc_version, pandoc_from, pandoc_to, text]).encode("utf8")
+    ).hexdigest()
+    return os.path.join(pandoc_cache, key[:2], key[2:] + ".md")
+
+
+def convert_mediawiki(texts, mw_filenames):
+    """Convert cleaned up MediaWiki texts to Markdown.
+
+    Uses the fast path and/or pandoc cache if enabled. Any other pages are
+    converted with pandoc, in batches of up to --pandoc-batch pages per call.
+    Returns a list of tuples of the Markdown, any warnings, and how it was
+    converted ("fast", "cached", "pandoc", or "different" if checking the
+    fast path and it did not match pandoc).
+    """
+    results = [None] * len(texts)
+    fast = [None] * len(texts)
+    todo = []
+    for i, text in enumerate(texts):
+        if args.fast_path or args.check_fast_path:
+            with stage("fast_path"):
+                fast[i] = fast_mediawiki_to_gfm(text)
+            if fast[i] is not None and not args.check_fast_path:
+                results[i] = (fast[i], "", "fast")
+                continue
+        if pandoc_cache:
+            with stage("pandoc_cache"):
+                cache_filename = pandoc_cache_filename(text)
+                if os.path.isfile(cache_filename):
+                    with open(cache_filename) as handle:
+                        markdown = handle.read()
+                    # Using the modification time to track least recently used:
+                    os.utime(cache_filename)
+                    results[i] = (markdown, "", "cached")
+            if results[i]:
+                continue
+        todo.append(i)
+
+    for start in range(0, len(todo), max(1, args.pandoc_batch)):
+        batch = todo[start : start + max(1, args.pandoc_batch)]
+        with stage("pandoc", len(batch)):
+            converted = run_pandoc_batch(
+                [texts[i] for i in batch], [mw_filenames[i] for i in batch]
+            )
+        for i, (markdown, warnings) in zip(batch, converted):
+            results[i] = (markdown, warnings, "pandoc")
+            if not pandoc_cache:
+                continue
+            with stage("pandoc_cache"):
+                cache_filename = pandoc_cache_filename(texts[i])
+                os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+                # Write under a temporary name first so never have partial
+                # entries, including the PID as with --jobs could have
+                # multiple processes:
+                tmp_filename = "%s.%i.tmp" % (cache_filename, os.getpid())
+                with open(tmp_filename, "w") as handle:
+                    handle.write(markdown)
+                os.replace(tmp_filename, cache_filename)
+
+    if args.check_fast_path:
+        for i, markdown in enumerate(fast):
+            if markdown is None:
+                continue
+            elif markdown == results[i][0]:
+                results[i] = (markdown, results[i][1], "fast")
+            else:
+                diff = difflib.unified_diff(
+                    results[i][0].splitlines(True),
+                    markdown.splitlines(True),
+                    "pandoc",
+                    "fast path",
+                )
+                results[i] = (
+                    results[i][0],
+                    "WARNING - fast path differs from pandoc for %s:\n%s%s"
+                    % (mw_filenames[i], "".join(diff), results[i][1]),
+                    "different",
+                )
+    return results
+
+
+def evict_pandoc_cache():
+    """Remove least recently used cache entries to get under the size limit."""
+    entries = []
+    total = 0
+    for filename in glob.glob(os.path.join(pandoc_cache, "*", "*.md")):
+        info = os.stat(filename)
+        entries.append((info.st_mtime, info.st_size, filename))
+        total += info.st_size
+    evicted = 0
+    for mtime, size, filename in sorted(entries):
+        if total <= pandoc_cache_size * 1024 * 1024:
+            break
+        os.remove(filename)
+        total -= size
+        evicted += 1
+    return evicted
+
+
+class CleanedPages:
+    """Cleaned up MediaWiki pages waiting to be converted.
+
+    Pages are kept in memory up to the given limit (measured approximately
+    as characters of text), with any more spilled to a temporary SQLite
+    database on disk with the text compressed.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self.pages = {}
+        self.spill = None
+        self.spilled = 0
+
+    def add(self, mw_filename, text, categories, title):
+        """Store the cleanup_mediawiki output for this file."""
+        if mw_filename in self.pages:
+            # Replacing it
+            self.size -= len(self.pages.pop(mw_filename)[0])
+        if self.size + len(text) <= self.limit:
+            self.pages[mw_filename] = (text, categories, title)
+            self.size += len(text)
+            return
+        if self.spill is None:
+            # An empty filename gives a private temporary database:
+            self.spill = sqlite3.connect("")
+            self.spill.execute(
+                "CREATE TABLE pages "
+                "(filename text PRIMARY KEY, content blob, categories text, title text)"
+            )
+        # Category names come from a single line, so can't contain newlines
+        self.spill.execute(
+            "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)",
+            (
+                mw_filename,
+                zlib.compress(text.encode("utf8")),
+                "\n".join(categories),
+                title,
+            ),
+        )
+        self.spilled += 1
+
+    def __contains__(self, mw_filename):
+        if mw_filename in self.pages:
+            return True
+        return self.spill is not None and bool(
+            self.spill.execute(
+                "SELECT COUNT(*) FROM pages WHERE filename = ?", (mw_filename,)
+            ).fetchone()[0]
+        )
+
+    def pop(self, mw_filename):
+        """Return and forget the cleaned up text, categories and title."""
+        try:
+            text, categories, title = self.pages.pop(mw_filename)
+            self.size -= len(text)
+            return text, categories, title
+        except KeyError:
+            pass
+        content, categories, title = self.spill.execute(
+            "SELECT content, categories, title FROM pages WHERE filename = ?",
+            (mw_filename,),
+        ).fetchone()
+        self.spill.execute("DELETE FROM pages WHERE filename = ?", (mw_filename,))
+        return (
+            zlib.decompress(content).decode("utf8"),
+            categories.split("\n") if categories else [],
+            title,
+        )
+
+    def close(self):
+        """Remove any temporary database."""
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+
+
+def init_worker(options, version, redirects_from_map, permalinks_map):
+    """Set up the global settings in a worker process for --jobs."""
+    global args, prefix, mediawiki_ext, markdown_ext, pandoc_cache
+    global pandoc_version, redirects_from, permalinks, languages
+    args = options
+    prefix = options.prefix
+    mediawiki_ext = options.mediawiki_ext
+    markdown_ext = options.markdown_ext
+    pandoc_cache = options.pandoc_cache
+    languages = [_.strip().lower() for _ in options.languages.split(",") if _.strip()]
+    pandoc_version = version
+    redirects_from = redirects_from_map
+    permalinks = permalinks_map
+
+
+def find_redirect(text):
+    """Return the target and if external for a cleaned up redirect page.
+
+    Returns (None, False) if the page is not a redirect.
+    """
+    text = text.strip()
+    if text.startswith("#REDIRECT [[") and text.endswith("]]"):
+        redirect = text[12:-2]
         if "\n" not in redirect and "]" not in redirect:
             # Maybe I should just have written a regular expression?
+            return redirect, False
+    elif text.startswith("{{#externalredirect:") and text.endswith("}}"):
+        return text[21:-2].strip(), True
+    return None, False
+
+
+def redirect_page(title, redirect):
+    """Return the Markdown for a page redirecting to the given URL."""
+    return (
+        f"---\ntitle: {title}\npermalink: {make_url(title)}\n"
+        f"redirect_to: {redirect}\n---\n\n"
+        f"You should be redirected to <{redirect}>\n"
+    )
+
+
+def make_header(title, categories):
+    """Return our YAML header for the Markdown version of a page."""
+    lines = ["---", "title: %s" % title, "permalink: %s" % make_url(title)]
+    if title.startswith("Category:"):
+        # This assumes have layout template called tagpage
+        # which will insert the tag listing automatically
+        # i.e. Behaves like MediaWiki for Category:XXX
+        # where we mapped XXX as a tag in Jekyll
+        lines.append("layout: tagpage")
+        lines.append("tag: %s" % title[9:])
+    else:
+        # Not a category page,
+        if default_layout:
+            lines.append("layout: %s" % default_layout)
+        if categories:
+            # Map them to Jekyll tags as can have more than one per page:
+            lines.append("tags:")
+            for category in categories:
+                lines.append(" - %s" % category)
+    if title in redirects_from:
+        lines.append("redirect_from:")
+        for redirect in sorted(redirects_from[title]):
+            lines.append(" - %s" % make_url(redirect))
+    lines.append("---\n\n")
+    return "\n".join(lines)
+
+
+def convert_batch(pages):
+    """Convert cleaned up MediaWiki pages to Markdown with our YAML header.
+
+    Takes a list of tuples of the filename and the cleanup_mediawiki output.
+    Returns a list of tuples of the Markdown, any warnings, and how it was
+    converted (see convert_mediawiki). Does not write the output files, leaving that to
+    the caller (so with --jobs this can run in a worker process).
+    """
+    results = []
+    for (mw_filename, text, categories, title), (stdout, warnings, how) in zip(
+        pages,
+        convert_mediawiki([_[1] for _ in pages], [_[0] for _ in pages]),
+    ):
+        with stage("cleanup_markdown"):
+            markdown = make_header(title, categories) + cleanup_markdown(
+                stdout, make_url(title), permalinks
+            )
+        results.append((markdown, warnings, how))
+    return results
+
+
+def convert_batch_in_worker(pages):
+    """Run convert_batch in a --jobs worker, also returning the stage timings.
+
+    The timings are reset for each batch, for the caller to add up.
+    """
+    stage_times.clear()
+    return convert_batch(pages), stage_times
+
+
+def add_worker_stage_times(times):
+    """Add the stage timings from a worker process to our own."""
+    for name, (wall, cpu, count) in times.items():
+        add_stage_time(name, wall, cpu, count)
+
+
+def convert_pages(mw_filenames, cleaned):
+    """Yield (filename, Markdown, warnings, how) tuples in order.
+
+    The cleaned up pages are taken from the given CleanedPages store as
+    needed, and converted in batches of --pandoc-batch pages. With --jobs
+    this uses a pool of worker processes, keeping a limited number of
+    batches ahead of the caller.
+    """
+    size = max(1, args.pandoc_batch)
+    batches = (
+        [(_,) + cleaned.pop(_) for _ in mw_filenames[i : i + size]]
+        for i in range(0, len(mw_filenames), size)
+    )
+    if args.jobs <= 1:
+        for batch in batches:
+            for page, result in zip(batch, convert_batch(batch)):
+                yield (page[0],) + result
+        return
+    pending = []
+    with concurrent.futures.ProcessPoolExecutor(
+        args.jobs,
+        initializer=init_worker,
+        initargs=(args, pandoc_version, redirects_from, permalinks),
+    ) as pool:
+        try:
+            for batch in batches:
+                pending.append(
+                    (
+                        [_[0] for _ in batch],
+                        pool.submit(convert_batch_in_worker, batch),
+                    )
+                )
+                if len(pending) >= 4 * args.jobs:
+                    batch, future = pending.pop(0)
+                    results, times = future.result()
+                    add_worker_stage_times(times)
+                    for mw_filename, result in zip(batch, results):
+                        yield (mw_filename,) + result
+            for batch, future in pending:
+                results, times = future.result()
+                add_worker_stage_times(times)
+                for mw_filename, result in zip(batch, results):
+                    yield (mw_filename,) + result
+        except BaseException:
+            # Don't start converting any more pages
+            pool.shutdown(cancel_futures=True)
+            raise
+
+
+# Increase this when changing the manifest entries, so older ones are ignored:
+manifest_format = 2
+
+
+def load_manifest(filename):
+    """Load the --incremental manifest, or return an empty one.
+
+    The manifest maps each MediaWiki filename to a dictionary recording the
+    file's size, modification time and SHA1 checksum, the page title, any
+    redirect, the pages it links to, and the conversion_key of the Markdown
+    written for it.
+    """
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename) as handle:
+        manifest = json.load(handle)
+    if manifest.get("version") != manifest_format:
+        sys.stderr.write(f"WARNING - ignoring old manifest {filename}\n")
+        return {}
+    return manifest["pages"]
+
+
+def save_manifest(filename, pages):
+    """Write the --incremental manifest (replacing any old version)."""
+    with open(filename + ".tmp", "w") as handle:
+        json.dump(
+            {"version": manifest_format, "pages": pages},
+            handle,
+            indent=1,
+            sort_keys=True,
+        )
+    os.replace(filename + ".tmp", filename)
+
+
+def conversion_key(entry, title):
+    """Return a checksum of everything the Markdown for a page depends on.
+
+    That is the MediaWiki file itself, the settings and pandoc version,
+    any pages redirecting to this one (used in the header), and if using
+    --resolve-links the permalinks of the pages it links to (so adding or
+    renaming a page only reconverts the pages linking to it).
+    """
+    key = hashlib.sha1()
+    for value in [
+        entry["sha1"],
+        pandoc_version,
+        pandoc_to,
+        prefix,
+        default_layout,
+        ",".join(languages),
+    ] + sorted(redirects_from.get(title, [])):
+        key.update(str(value).encode("utf8") + b"\0")
+    if args.resolve_links:
+        key.update(b"resolve-links\0")
+        for page in entry["links"]:
+            key.update(f"{page}\0{permalinks.get(page)}\0".encode("utf8"))
+    return key.hexdigest()
+
+
+if __name__ == "__main__":
+    names = []
+    for name in args.input:
+        if name.startswith("../"):
+            sys.exit(
+                f"ERROR: Input files must be within the current directory and git repo"
+            )
+        if os.path.isdir(name):
+            names.extend(glob.glob(name + "/*." + mediawiki_ext))
+        elif os.path.isfile(name) and name.endswith("." + mediawiki_ext):
+            names.append(name)
+        else:
+            sys.exit(f"ERROR: Unexpected input {name}")
+    # The same file could be given directly and via its folder:
+    names = list(dict.fromkeys(names))
+    print(f"Have {len(names)} input MediaWiki files")
+
+    # Read and clean up each file once, looking for redirects, and keeping
+    # the other pages to convert once we know all the redirects
+    print("Reading pages and checking for redirects...")
+    manifest = load_manifest(args.incremental) if args.incremental else {}
+    pages = {}
+    cleaned = CleanedPages(args.memory_limit * 1024 * 1024)
+    if profiler:
+        profiler.enable()
+    scan_start = time.perf_counter()
+    scan_cpu = cpu_time()
+    for mw_filename in names:
+        stat = os.stat(mw_filename)
+        entry = manifest.get(mw_filename)
+        md_filename = mw_filename[: -len(mediawiki_ext)] + markdown_ext
+        if (
+            entry
+            and entry["size"] == stat.st_size
+            and entry["mtime"] == stat.st_mtime_ns
+            and (
+                (entry["redirect"] and not entry["external"])
+                or os.path.isfile(md_filename)
+            )
+        ):
+            # Unchanged since the last --incremental run, so don't read it
+            pages[mw_filename] = entry
+            title = entry["title"]
+            if entry["redirect"]:
+                redirects[mw_filename] = entry["redirect"]
+                if not entry["external"]:
+                    redirects_from.setdefault(entry["redirect"], []).append(title)
+            if args.resolve_links:
+                permalinks[title.replace(" ", "_")] = make_url(title)
+            continue
+
+        with stage("read"):
+            with open(mw_filename) as handle:
+                original = handle.read()
+
+        assert original.startswith("---\ntitle: "), mw_filename
+        with stage("cleanup_mediawiki"):
+            text, categories, title = cleanup_mediawiki(original)
+        if args.resolve_links:
+            permalinks[title.replace(" ", "_")] = make_url(title)
+        redirect, external = find_redirect(text)
+        if redirect and not external:
+            # Internal redirect, will become a redirect_from entry in target page
             # We will do these AFTER converting the target using redirect_from
             print(f" * redirection {mw_filename} --> {redirect}")
             redirects[mw_filename] = redirect
@@ -385,102 +1398,120 @@ for mw_filename in names:
                 redirects_from[redirect].append(title)
             except KeyError:
                 redirects_from[redirect] = [title]
-    elif text.strip().startswith("{{#externalredirect:") and text.strip().endswith(
-        "}}"
-    ):
-        # External redirect
-        redirect = text.strip()[21:-2].strip()
-        redirects[mw_filename] = redirect
-        print(f" * redirection {mw_filename} --> {redirect}")
+        elif redirect:
+            # External redirect
+            redirects[mw_filename] = redirect
+            print(f" * redirection {mw_filename} --> {redirect}")
+            if os.path.isfile(md_filename):
+                sys.stderr.write(f"WARNING - will overwrite {md_filename}\n")
+            with open(md_filename, "w") as handle:
+                handle.write(redirect_page(title, redirect))
+        if mw_filename not in redirects:
+            cleaned.add(mw_filename, text, categories, title)
+        if args.incremental:
+            pages[mw_filename] = {
+                "size": stat.st_size,
+                "mtime": stat.st_mtime_ns,
+                "sha1": hashlib.sha1(original.encode("utf8")).hexdigest(),
+                "title": title,
+                "redirect": redirects.get(mw_filename),
+                "external": external,
+                "links": linked_pages(text),
+                "converted": entry["converted"] if entry else None,
+            }
+    add_stage_time(
+        "redirect_scan",
+        time.perf_counter() - scan_start,
+        cpu_time() - scan_cpu,
+        len(names),
+    )
+    if profiler:
+        profiler.disable()
+    if cleaned.spilled:
+        print(f"Held {cleaned.spilled} cleaned up pages in a temporary file")
+
+    wanted = [_ for _ in names if _ not in redirects]
+    if args.incremental:
+        keys = {}
+        for mw_filename in wanted:
+            entry = pages[mw_filename]
+            keys[mw_filename] = conversion_key(entry, entry["title"])
+            md_filename = mw_filename[: -len(mediawiki_ext)] + markdown_ext
+            if entry["converted"] == keys[mw_filename] and os.path.isfile(md_filename):
+                # Unchanged, or touched but same content (e.g. by git)
+                if mw_filename in cleaned:
+                    cleaned.pop(mw_filename)
+                del keys[mw_filename]
+            elif mw_filename not in cleaned:
+                # File unchanged, but something else it depends on has
+                with open(mw_filename) as handle:
+                    cleaned.add(mw_filename, *cleanup_mediawiki(handle.read()))
+        print(f"Skipping {len(wanted) - len(keys)} unchanged pages")
+        wanted = [_ for _ in wanted if _ in keys]
+
+    print("Converting pages...")
+    if profiler:
+        profiler.enable()
+    convert_start = time.perf_counter()
+    convert_cpu = cpu_time()
+    converted = 0
+    for mw_filename, markdown, warnings, how in convert_pages(wanted, cleaned):
         md_filename = mw_filename[: -len(mediawiki_ext)] + markdown_ext
         if os.path.isfile(md_filename):
             sys.stderr.write(f"WARNING - will overwrite {md_filename}\n")
-        with open(md_filename, "w") as handle:
-            handle.write("---\n")
-            handle.write("title: %s\n" % title)
-            handle.write("permalink: %s\n" % make_url(title))
-            handle.write(f"redirect_to: {redirect}\n")
-            handle.write("---\n")
-            handle.write("\n")
-            handle.write(f"You should be redirected to <{redirect}>\n")
-
-
-print("Converting pages...")
-for mw_filename in names:
-    if mw_filename in redirects:
-        continue
-    md_filename = mw_filename[: -len(mediawiki_ext)] + markdown_ext
-    if os.path.isfile(md_filename):
-        sys.stderr.write(f"WARNING - will overwrite {md_filename}\n")
-
-    print(f" * {mw_filename} --> {md_filename}")
-
-    # Yes, sadly we've opened most files twice :(
-    with open(mw_filename) as handle:
-        original = handle.read()
-
-    assert original.startswith("---\ntitle: "), mw_filename
-    text, categories, title = cleanup_mediawiki(original)
-
-    with tempfile.NamedTemporaryFile("w", delete=False) as handle:
-        handle.write(text)
-        tmp_mediawiki = handle.name
-
-    # TODO - Try piping text via stdin
-    folder, local_filename = os.path.split(md_filename)
-    child = subprocess.Popen(
-        [
-            pandoc,
-            "-f",
-            "mediawiki",
-            "-t",
-            # "markdown_github-hard_line_breaks",
-            "gfm-hard_line_breaks",
-            tmp_mediawiki,
-        ],
-        text=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
-    stdout, stderr = child.communicate()
 
-    # What did pandoc think?
-    if stderr or child.returncode:
-        print(stdout)
-    if stderr:
-        sys.stderr.write(stderr)
-    if child.returncode:
-        sys.stderr.write("Error %i from pandoc\n" % child.returncode)
-    if not stdout:
-        sys.stderr.write("No output from pandoc for %r\n" % mw_filename)
-    if child.returncode or not stdout:
-        sys.exit("ERROR - Calling pandoc failed")
-    with open(md_filename, "w") as handle:
-        handle.write("---\n")
-        handle.write("title: %s\n" % title)
-        handle.write("permalink: %s\n" % make_url(title))
-        if title.startswith("Category:"):
-            # This assumes have layout template called tagpage
-            # which will insert the tag listing automatically
-            # i.e. Behaves like MediaWiki for Category:XXX
-            # where we mapped XXX as a tag in Jekyll
-            handle.write("layout: tagpage\n")
-            handle.write("tag: %s\n" % title[9:])
-        else:
-            # Not a category page,
-            if default_layout:
-                handle.write("layout: %s\n" % default_layout)
-            if categories:
-                # Map them to Jekyll tags as can have more than one per page:
-                handle.write("tags:\n")
-                for category in categories:
-                    handle.write(" - %s\n" % category)
-        if title in redirects_from:
-            handle.write("redirect_from:\n")
-            for redirect in sorted(redirects_from[title]):
-                handle.write(" - %s\n" % make_url(redirect))
-        handle.write("---\n\n")
-        handle.write(cleanup_markdown(stdout, make_url(title)))
-    os.remove(tmp_mediawiki)
-
-print("Done")
+        print(f" * {mw_filename} --> {md_filename}")
+        if warnings:
+            sys.stderr.write(warnings)
+        converted_by[how] += 1
+        with stage("file_write"):
+            # Write under a temporary name first so never have partial output:
+            with open(md_filename + ".tmp", "w") as handle:
+                handle.write(markdown)
+            os.replace(md_filename + ".tmp", md_filename)
+        if args.incremental:
+            pages[mw_filename]["converted"] = keys[mw_filename]
+        converted += 1
+        if args.profile and converted % 100 == 0:
+            elapsed = time.perf_counter() - convert_start
+            sys.stderr.write(
+                f"Progress: {converted} of {len(wanted)} pages, "
+                f"{converted / elapsed:.1f} per second, ETA "
+                f"{format_seconds((len(wanted) - converted) * elapsed / converted)}, "
+                f"peak memory {peak_memory()}\n"
+            )
+    add_stage_time(
+        "convert_loop",
+        time.perf_counter() - convert_start,
+        cpu_time() - convert_cpu,
+        converted,
+    )
+    if profiler:
+        profiler.disable()
+    cleaned.close()
+    if args.incremental:
+        save_manifest(args.incremental, pages)
+
+    if pandoc_cache:
+        evicted = evict_pandoc_cache()
+        print(
+            f"Pandoc cache: {converted_by['cached']} hits, "
+            f"{converted_by['pandoc']} misses, "
+            f"removed {evicted} old entries"
+        )
+    if args.fast_path or args.check_fast_path:
+        print(f"Converted {converted_by['fast']} pages without pandoc")
+    if args.check_fast_path:
+        print(f"Fast path differed from pandoc for {converted_by['different']} pages")
+    if args.profile or args.stats_json:
+        report_stages(
+            "mediawiki_to_md.py",
+            __version__,
+            args,
+            time.perf_counter() - script_start,
+            cpu_time() - script_cpu,
+            dict(converted_by, input=len(names), converted=converted),
+        )
+    if profiler:
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+    print("Done")
@@ -0,0 +1,129 @@
+"""Stage timing and memory reporting for --profile and --stats-json.
+
+Shared by xml_to_git.py and mediawiki_to_md.py, which must be next to
+this file.
+"""
+
+import contextlib
+import json
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+# Wall and CPU time spent in each stage, as stage name to
+# [wall seconds, CPU seconds, count]. Worker processes send theirs back
+# to be added up in the main process, while xml_to_git.py decompresses
+# in other threads (hence the lock):
+stage_times = {}
+stage_lock = threading.Lock()
+
+
+def peak_memory(usage=None):
+    """Peak resident memory of this process as a string like '123 MB'.
+
+    Optional argument usage is from resource.getrusage, e.g. for the
+    largest child process.
+    """
+    if resource is None:
+        return "unknown"
+    if usage is None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+    peak = usage.ru_maxrss
+    if sys.platform == "darwin":
+        # Reported in bytes rather than kilobytes
+        peak //= 1024
+    return "%i MB" % (peak // 1024)
+
+
+def cpu_time():
+    """CPU seconds used by this process and its finished child processes."""
+    if resource is None:
+        return time.process_time()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+def add_stage_time(name, wall, cpu, count=1):
+    """Add to the time recorded for this stage (thread safe)."""
+    with stage_lock:
+        entry = stage_times.setdefault(name, [0.0, 0.0, 0])
+        entry[0] += wall
+        entry[1] += cpu
+        entry[2] += count
+
+
+@contextlib.contextmanager
+def stage(name, count=1):
+    """Record the wall and CPU time of the with block as part of this stage."""
+    wall = time.perf_counter()
+    cpu = cpu_time()
+    try:
+        yield
+    finally:
+        add_stage_time(name, time.perf_counter() - wall, cpu_time() - cpu, count)
+
+
+def format_seconds(seconds):
+    """Format a duration like '45s', '12m05s' or '3h20m' for progress messages."""
+    seconds = int(seconds)
+    if seconds < 60:
+        return "%is" % seconds
+    elif seconds < 3600:
+        return "%im%02is" % (seconds // 60, seconds % 60)
+    return "%ih%02im" % (seconds // 3600, (seconds // 60) % 60)
+
+
+def report_stages(script, version, options, wall, cpu, counts):
+    """Print the stage timings with --profile, and write them with --stats-json.
+
+    The options are the script's parsed command line arguments.
+    """
+    stages = {}
+    for name, (stage_wall, stage_cpu, count) in stage_times.items():
+        stages[name] = {
+            "wall_seconds": round(stage_wall, 4),
+            "cpu_seconds": round(stage_cpu, 4),
+            "count": count,
+            "per_second": round(count / stage_wall, 1) if stage_wall else None,
+        }
+    if options.profile:
+        print("=" * 60)
+        print(
+            "%-22s %10s %10s %10s %12s"
+            % ("Stage", "Wall", "CPU", "Count", "Per second")
+        )
+        for name, entry in stages.items():
+            print(
+                "%-22s %9.2fs %9.2fs %10i %12.1f"
+                % (
+                    name,
+                    entry["wall_seconds"],
+                    entry["cpu_seconds"],
+                    entry["count"],
+                    entry["per_second"] or 0,
+                )
+            )
+        print("%-22s %9.2fs %9.2fs" % ("Total", wall, cpu))
+        print(f"Peak memory {peak_memory()}")
+    if options.stats_json:
+        children = resource.getrusage(resource.RUSAGE_CHILDREN) if resource else None
+        stats = {
+            "script": script,
+            "version": version,
+            "arguments": sys.argv[1:],
+            "wall_seconds": round(wall, 4),
+            "cpu_seconds": round(cpu, 4),
+            "peak_memory": peak_memory(),
+            "peak_child_memory": peak_memory(children),
+            "counts": counts,
+            "stages": stages,
+        }
+        with open(options.stats_json, "w") as handle:
+            json.dump(stats, handle, indent=2)
+            handle.write("\n")
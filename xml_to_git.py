@@ -1,13 +1,39 @@
 #!/usr/bin/env python3
 import argparse
+import bz2
+import calendar
+import cProfile
+import gzip
+import hashlib
+import heapq
+import multiprocessing
 import os
+import pickle
+import pstats
 import sys
 import subprocess
 import sqlite3
 import base64
 import re
+import shutil
+import tempfile
+import time
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from queue import Queue
 from xml.etree import cElementTree as ElementTree
 
+from stage_timing import (
+    add_stage_time,
+    cpu_time,
+    format_seconds,
+    peak_memory,
+    report_stages,
+    stage,
+    stage_times,
+)
+
 # User configurable bits (ought to be command line options?):
 
 debug = False
@@ -101,16 +127,141 @@ parser.add_argument(
     default="mediawiki",
     help="File extension for MediaWiki files, default 'mediawiki'.",
 )
+parser.add_argument(
+    "--markdown",
+    action="store_true",
+    help="Commit every revision of the pages converted to Markdown (using "
+    "mediawiki_to_md.py and pandoc), rather than the original MediaWiki "
+    "markup. The revisions are converted in parallel, see --jobs.",
+)
+parser.add_argument(
+    "--markdown-ext",
+    metavar="EXT",
+    default="md",
+    help="File extension for Markdown files with --markdown, default 'md'.",
+)
+parser.add_argument(
+    "-j",
+    "--jobs",
+    metavar="N",
+    type=int,
+    default=os.cpu_count() or 1,
+    help="With --markdown, worker processes converting the revisions ahead "
+    "of the commits, default is number of CPUs.",
+)
+parser.add_argument(
+    "--fast-import",
+    action="store_true",
+    help="Stream all the commits into a single 'git fast-import' process "
+    "rather than calling 'git add' and 'git commit' for each revision. "
+    "Much faster, and the working tree is only updated at the end.",
+)
+parser.add_argument(
+    "--checkpoint-every",
+    metavar="N",
+    type=int,
+    default=1000,
+    help="With --fast-import, how often to update the branch and record "
+    "progress for resuming if interrupted, default every 1000 commits. "
+    "Otherwise progress is recorded after every commit.",
+)
+parser.add_argument(
+    "--squash-minutes",
+    metavar="MINUTES",
+    type=float,
+    default=0,
+    help="Squash a quick series of revisions to the same page by the same "
+    "user into a single commit, when within this many minutes of the first "
+    "of them and with the same or no comment. Default 0 (no squashing).",
+)
+parser.add_argument(
+    "--squash-any-comment",
+    action="store_true",
+    help="With --squash-minutes, also squash revisions with different "
+    "comments, combining them into the commit message.",
+)
+parser.add_argument(
+    "--restart",
+    action="store_true",
+    help="Ignore any progress recorded in the SQLite file from an earlier "
+    "interrupted run, and start committing from the first revision. "
+    "By default will resume if the current branch is where it stopped.",
+)
+parser.add_argument(
+    "--decompress-threads",
+    metavar="N",
+    type=int,
+    default=min(4, os.cpu_count() or 1),
+    help="Threads used to decompress gzip or bz2 XML ahead of the parser. "
+    "Multistream bz2 files (as from Wikimedia) are decompressed in parallel. "
+    "Use 0 to decompress within the parser instead. Default is number of "
+    "CPUs (up to 4).",
+)
+parser.add_argument(
+    "--ingest-jobs",
+    metavar="N",
+    type=int,
+    default=1,
+    help="Worker processes used to parse the XML dump, each handling a range "
+    "of the pages and saving them to its own temporary SQLite file, which "
+    "are then merged. Compressed dumps (or stdin) are first decompressed to "
+    "a temporary file (in $TMPDIR). Default 1 (no workers).",
+)
+parser.add_argument(
+    "--external-sort",
+    action="store_true",
+    help="Sort the revisions by date using temporary files rather than a "
+    "SQLite file, for a one-shot import (e.g. from stdin). Nothing is kept "
+    "for reuse, or to resume from if interrupted. See --sort-memory.",
+)
+parser.add_argument(
+    "--sort-memory",
+    metavar="MB",
+    type=int,
+    default=256,
+    help="With --external-sort, roughly how much revision text and uploads "
+    "to hold in memory before writing them sorted to a temporary file "
+    "(in $TMPDIR), default 256.",
+)
+parser.add_argument(
+    "--stats-json",
+    metavar="FILENAME",
+    help="Write the wall and CPU time spent in each stage (decompression, "
+    "XML parsing, SQLite inserts, file writes, git add, git commit, etc), "
+    "rates, and peak memory use to this JSON file.",
+)
+parser.add_argument(
+    "--profile",
+    action="store_true",
+    help="Print progress of the commits with an estimated time remaining, "
+    "a table of the time spent in each stage at the end, and the functions "
+    "taking the most time in the main loops (using cProfile, which will "
+    "slow things down).",
+)
 
 args = parser.parse_args()
+script_start = time.perf_counter()
+script_cpu = time.process_time()
+profiler = cProfile.Profile() if args.profile else None
 
 mediawiki_xml_dump = args.input
-page_whitelist = args.titles
+page_whitelist = set(args.titles) if args.titles else None
 prefix = args.prefix
 mediawiki_ext = args.mediawiki_ext
 user_table = args.usernames
 user_blocklist = args.blocklist
 default_email = args.default_email
+use_fast_import = args.fast_import
+checkpoint_every = args.checkpoint_every
+restart = args.restart
+squash_seconds = args.squash_minutes * 60
+decompress_threads = args.decompress_threads
+markdown_ext = args.markdown_ext
+ingest_jobs = args.ingest_jobs
+
+if args.markdown and "fork" not in multiprocessing.get_all_start_methods():
+    # The conversion workers rely on inheriting the mediawiki_to_md settings
+    sys.exit("ERROR: Option --markdown is not supported on this platform")
 
 # Do these need to be configurable?:
 page_prefixes_to_ignore = [
@@ -126,6 +277,7 @@ git = "git"  # assume on path
 
 missing_users = dict()
 unwanted_commits = 0
+squashed_revisions = 0
 
 
 assert os.path.isdir(".git"), "Expected to be in a Git repository!"
@@ -169,7 +321,6 @@ else:
     sys.stderr.write("WARNING - running without username ignore list\n")
 
 
-
 def clean_tag(tag):
     while "}" in tag:
         tag = tag[tag.index("}") + 1 :]
@@ -183,8 +334,8 @@ def make_cannonical(title):
     return title[0].upper() + title[1:].lower()
 
 
-def make_filename(title, ext):
-    """Spaces/colons/slahses to underscores; adds extension given.
+def make_name(title):
+    """Spaces/colons/slahses to underscores, for use as a filename.
 
     Want to avoid colons in filenames for Windows, fix the URL via
     the YAML header with a permalink entry.
@@ -193,12 +344,7 @@ def make_filename(title, ext):
     with automatic links when there are child-folders. Again we
     get the desired URL via the YAML header permalink entry.
     """
-    return os.path.join(
-        prefix,
-        title.replace(" ", "_").replace(":", "_").replace("/", "_")
-        + os.path.extsep
-        + ext,
-    )
+    return title.replace(" ", "_").replace(":", "_").replace("/", "_")
 
 
 def ignore_by_prefix(title):
@@ -208,6 +354,32 @@ def ignore_by_prefix(title):
     return False
 
 
+def page_wanted(title):
+    """Should revisions and uploads for this page be saved while parsing?
+
+    Checks the ignored prefixes, and the white-list if any.
+    """
+    if ignore_by_prefix(title):
+        return False
+    return not page_whitelist or title in page_whitelist
+
+
+def catalog_entry(title):
+    """Return the row for this title in the pages table of the SQLite file.
+
+    That is the title, namespace (e.g. 'File', or '' for the main namespace),
+    the name used for the file (before adding the prefix folder, and for
+    pages the extension), and the case-folded title for spotting clashes
+    on case insensitive file systems.
+    """
+    namespace = title.split(":", 1)[0] if ":" in title else ""
+    if namespace == "File":
+        name = make_cannonical(title[5:])  # should already have extension
+    else:
+        name = make_name(title)
+    return title, namespace, name, title.lower()
+
+
 def runsafe(cmd_array):
     args = []
     for el in cmd_array:
@@ -218,27 +390,39 @@ def runsafe(cmd_array):
         sys.exit(return_code)
 
 
-def commit_files(filenames, username, date, comment):
-    assert filenames, "Nothing to commit: %r" % filenames
-    for f in filenames:
-        assert f and os.path.isfile(f), f
-    cmd = [git, "add"] + filenames
-    runsafe(cmd)
-    # TODO - how to detect and skip empty commit?
+def get_author(username):
+    """Map MediaWiki username to a git author string 'name <email>'."""
     if username in user_mapping:
-        author = user_mapping[username]
+        return user_mapping[username]
     elif username in blocklist:
-        author = "Unwanted Contributor %s <%s>" % (username, default_email)
+        return "Unwanted Contributor %s <%s>" % (username, default_email)
     elif username:
         global missing_users
         try:
             missing_users[username] += 1
         except KeyError:
             missing_users[username] = 1
-        author = "%s <%s>" % (username, default_email)
+        return "%s <%s>" % (username, default_email)
     else:
         # git insists on a name, not just an email address:
-        author = "Anonymous Contributor <%s>" % default_email
+        return "Anonymous Contributor <%s>" % default_email
+
+
+def parse_date(date):
+    """MediaWiki timestamp like 2008-06-23T10:00:00Z to seconds since epoch."""
+    return calendar.timegm(time.strptime(date, "%Y-%m-%dT%H:%M:%SZ"))
+
+
+def commit_files(filenames, username, date, comment):
+    assert filenames, "Nothing to commit: %r" % filenames
+    for f in filenames:
+        assert f and os.path.isfile(f), f
+    cmd = [git, "add"] + filenames
+    with stage("git_add"):
+        runsafe(cmd)
+    # Revisions which would not change the file were skipped by the caller,
+    # but keep --allow-empty in case of anything else (e.g. a resumed run).
+    author = get_author(username)
     if not comment:
         comment = "No comment"
     # In order to handle quotes etc in the message, rather than -m "%s"
@@ -250,11 +434,12 @@ def commit_files(filenames, username, date, comment):
         + filenames
         + ["--date", date, "--author", author, "-F", "-", "--allow-empty"]
     )
-    child = subprocess.Popen(
-        cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-    )
-    child.stdin.write(comment.encode("utf8"))
-    stdout, stderr = child.communicate()
+    with stage("git_commit"):
+        child = subprocess.Popen(
+            cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        child.stdin.write(comment.encode("utf8"))
+        stdout, stderr = child.communicate()
     if child.returncode or stderr:
         sys.stderr.write(stdout.decode("utf8"))
     if stderr:
@@ -265,23 +450,549 @@ def commit_files(filenames, username, date, comment):
         sys.exit(child.returncode)
 
 
-def parse_xml(mediawiki_xml_dump):
-    print("=" * 60)
-    print("Parsing XML and saving revisions by page.")
+# Alternative backend using a single long lived git fast-import process,
+# see https://git-scm.com/docs/git-fast-import for the stream format.
+fast_import = None
+fast_import_ref = None
+fast_import_start = None
+fast_import_index = None
+fast_import_committer = None
+fast_import_marks = 0
 
-    if mediawiki_xml_dump in ["-", "/dev/stdin"]:
-        xml_handle = open("/dev/stdin", "rb")
-    elif mediawiki_xml_dump.endswith(".gz"):
-        import gzip
 
-        xml_handle = gzip.open(mediawiki_xml_dump, "rb")
+def git_output(cmd_array):
+    """Run git command and return its stripped output, or None on failure."""
+    child = subprocess.run(cmd_array, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if child.returncode:
+        return None
+    return child.stdout.decode("utf8").strip()
+
+
+def start_fast_import():
+    global fast_import, fast_import_ref, fast_import_start, fast_import_committer
+    global fast_import_index
+    fast_import_ref = git_output([git, "symbolic-ref", "-q", "HEAD"])
+    if not fast_import_ref:
+        sys.exit("ERROR: Using git fast-import needs a branch, not a detached HEAD")
+    # This will be None on a new repository without any commits yet:
+    fast_import_start = git_output([git, "rev-parse", "--verify", "-q", "HEAD"])
+    # Use the same committer as git commit would (name, email, and now):
+    fast_import_committer = git_output([git, "var", "GIT_COMMITTER_IDENT"])
+    if not fast_import_committer:
+        sys.exit("ERROR: Could not determine git committer identity")
+    # What the index and working tree currently hold (which after resuming
+    # an interrupted fast-import will be older than HEAD):
+    fast_import_index = git_output([git, "write-tree"])
+    if not fast_import_index:
+        sys.exit("ERROR: Could not record git index state")
+    fast_import = subprocess.Popen(
+        [git, "fast-import", "--quiet", "--done"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+    )
+
+
+def clean_message(comment):
+    """Tidy commit message whitespace the same way git commit does by default.
+
+    That strips trailing whitespace, leading and trailing blank lines,
+    collapses consecutive blank lines, and ends with a newline.
+    """
+    lines = []
+    for line in comment.split("\n"):
+        line = line.rstrip()
+        if line or (lines and lines[-1]):
+            lines.append(line)
+    while lines and not lines[-1]:
+        lines.pop()
+    return "\n".join(lines) + "\n"
+
+
+def fast_import_path(filename):
+    """Path as used in the fast-import stream, quoted if required."""
+    path = filename.replace(os.path.sep, "/")
+    if path.startswith('"') or "\n" in path:
+        path = path.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        path = '"%s"' % path
+    return path
+
+
+def fast_import_commit(filename, chunks, size, username, date, comment):
+    """Send commit of a single file with given chunks of bytes to git fast-import."""
+    global fast_import_marks
+    author = get_author(username)
+    if not comment:
+        comment = "No comment"
+    message = clean_message(comment).encode("utf8")
+    fast_import_marks += 1
+    handle = fast_import.stdin
+    handle.write(
+        (
+            "commit %s\nmark :%i\nauthor %s %i +0000\ncommitter %s\ndata %i\n"
+            % (
+                fast_import_ref,
+                fast_import_marks,
+                author,
+                parse_date(date),
+                fast_import_committer,
+                len(message),
+            )
+        ).encode("utf8")
+    )
+    handle.write(message)
+    if fast_import_marks == 1 and fast_import_start:
+        # First commit in this session, continue from the current branch
+        handle.write(("from %s\n" % fast_import_start).encode("utf8"))
+    handle.write(
+        ("M 100644 inline %s\ndata %i\n" % (fast_import_path(filename), size)).encode(
+            "utf8"
+        )
+    )
+    for chunk in chunks:
+        handle.write(chunk)
+    handle.write(b"\n")
+
+
+def fast_import_checkpoint():
+    """Ask git fast-import to update the branch now, returns its commit."""
+    with stage("fast_import_checkpoint"):
+        fast_import.stdin.write(b"checkpoint\nprogress checkpoint\n")
+        fast_import.stdin.flush()
+        # Wait for it to get as far as the progress command:
+        if not fast_import.stdout.readline():
+            sys.stderr.write("Error from git fast-import at checkpoint\n")
+            sys.exit(fast_import.wait() or 1)
+    return git_output([git, "rev-parse", "--verify", "-q", fast_import_ref])
+
+
+def finish_fast_import():
+    """Wait for git fast-import, then update the index and working tree."""
+    global fast_import
+    with stage("fast_import_finish"):
+        fast_import.stdin.write(b"done\n")
+        fast_import.stdin.close()
+        return_code = fast_import.wait()
+    fast_import = None
+    if return_code:
+        sys.stderr.write("Error %i from git fast-import\n" % return_code)
+        sys.exit(return_code)
+    # Bring the working tree up to date with the new commits on the branch,
+    # similar to what git merge would do for a fast-forward:
+    with stage("git_read_tree"):
+        runsafe([git, "read-tree", "-m", "-u", fast_import_index, "HEAD"])
+
+
+def commit_contents(filename, contents, username, date, comment, size=None):
+    """Commit a single file with given contents via chosen backend.
+
+    The contents are bytes, or if the size is given an iterator of chunks
+    of bytes (so that large uploads need not be held in memory at once).
+    """
+    global resumed_commit
+    if already_committed:
+        # Resuming, and this was committed last time but not yet recorded
+        resumed_commit, author_date = already_committed.popleft()
+        if author_date != parse_date(date):
+            sys.exit(
+                f"ERROR: Expected commit {resumed_commit} to be from {date}, "
+                "use --restart after resetting your branch"
+            )
+        print(f"Already committed as {resumed_commit}")
+        return
+    if size is None:
+        size = len(contents)
+        contents = [contents]
+    if fast_import:
+        with stage("fast_import"):
+            fast_import_commit(filename, contents, size, username, date, comment)
+    else:
+        with stage("file_write"):
+            with open(filename, "wb") as handle:
+                for chunk in contents:
+                    handle.write(chunk)
+        commit_files([filename], username, date, comment)
+
+
+class ChunkReader:
+    """Minimal read-only file-like wrapper for an iterator of bytes."""
+
+    def __init__(self, chunks, handle):
+        self.chunks = chunks
+        self.handle = handle  # underlying file, closed with this
+        self.buffer = b""
+        self.offset = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            data = self.buffer[self.offset :] + b"".join(self.chunks)
+            self.buffer = b""
+            self.offset = 0
+            return data
+        while self.offset >= len(self.buffer):
+            # Note may return less than requested, which is fine
+            self.buffer = next(self.chunks, None)
+            self.offset = 0
+            if self.buffer is None:
+                self.buffer = b""
+                return b""
+        data = self.buffer[self.offset : self.offset + size]
+        self.offset += len(data)
+        return data
+
+    def close(self):
+        self.chunks.close()
+        self.handle.close()
+
+
+def read_ahead(handle, threads, chunk_size=1024 * 1024):
+    """Yield chunks read from the handle by a background thread.
+
+    Used with the gzip and bz2 modules which release the GIL while
+    decompressing, so this overlaps the decompression and XML parsing.
+    """
+    queue = Queue(maxsize=2 * threads)
+
+    def worker():
+        try:
+            while True:
+                wall = time.perf_counter()
+                cpu = time.thread_time()
+                data = handle.read(chunk_size)
+                add_stage_time(
+                    "decompression",
+                    time.perf_counter() - wall,
+                    time.thread_time() - cpu,
+                )
+                queue.put(data)
+                if not data:
+                    break
+        except Exception as err:
+            queue.put(err)
+
+    threading.Thread(target=worker, daemon=True).start()
+    while True:
+        data = queue.get()
+        if isinstance(data, Exception):
+            raise data
+        if not data:
+            break
+        yield data
+
+
+# Each bz2 stream begins with a header BZh1 to BZh9 (the block size),
+# and being the start of a stream its first block magic number is
+# byte aligned, so we can search for this to find stream boundaries:
+bz2_stream_start = re.compile(b"BZh[1-9]1AY&SY")
+
+
+def timed_bz2_decompress(data):
+    """Run bz2.decompress in a worker thread, recording the time taken."""
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    data = bz2.decompress(data)
+    add_stage_time(
+        "decompression", time.perf_counter() - wall, time.thread_time() - cpu
+    )
+    return data
+
+
+def split_bz2_streams(handle, chunk_size=1024 * 1024):
+    """Yield compressed data in chunks ending at bz2 stream boundaries."""
+    buffer = b""
+    while True:
+        data = handle.read(chunk_size)
+        if not data:
+            break
+        buffer += data
+        last = 0
+        # Only need to search the new data (and a little before it):
+        for match in bz2_stream_start.finditer(
+            buffer, max(1, len(buffer) - len(data) - 9)
+        ):
+            last = match.start()
+        if last:
+            yield buffer[:last]
+            buffer = buffer[last:]
+    if buffer:
+        yield buffer
+
+
+def decompress_bz2_streams(handle, threads):
+    """Yield decompressed data from a multistream bz2 file in order.
+
+    Groups of streams are decompressed in parallel by a pool of threads
+    (the bz2 module releases the GIL), keeping a limited number ahead.
+    """
+    chunks = split_bz2_streams(handle)
+    pending = deque()
+    with ThreadPoolExecutor(threads) as pool:
+        for chunk in chunks:
+            pending.append((chunk, pool.submit(timed_bz2_decompress, chunk)))
+            if len(pending) < 2 * threads:
+                continue
+            chunk, future = pending.popleft()
+            try:
+                yield future.result()
+            except (OSError, EOFError, ValueError):
+                yield decompress_bz2_retry(chunk, pending, chunks)
+        while pending:
+            chunk, future = pending.popleft()
+            try:
+                yield future.result()
+            except (OSError, EOFError, ValueError):
+                yield decompress_bz2_retry(chunk, pending, chunks)
+
+
+def decompress_bz2_retry(chunk, pending, chunks):
+    """Decompress chunk which failed, appending data from those following.
+
+    Most likely we split at a false match for a stream header within the
+    compressed data, so the chunk ended part way through a stream.
+    """
+    while True:
+        if pending:
+            more, future = pending.popleft()
+            future.cancel()
+        else:
+            more = next(chunks, None)
+            if more is None:
+                # Give up, will raise the original error:
+                return bz2.decompress(chunk)
+        chunk += more
+        try:
+            return bz2.decompress(chunk)
+        except (OSError, EOFError, ValueError):
+            pass
+
+
+class TimedReader:
+    """Minimal read-only file-like wrapper timing reads as decompression."""
+
+    def __init__(self, handle):
+        self.handle = handle
+
+    def read(self, size=-1):
+        with stage("decompression"):
+            return self.handle.read(size)
+
+    def close(self):
+        self.handle.close()
+
+
+dump_handle = None  # the underlying file, used to estimate progress
+
+
+def open_dump(mediawiki_xml_dump):
+    """Open the XML dump for reading as bytes, decompressing if needed."""
+    global dump_handle
+    if mediawiki_xml_dump in ["-", "/dev/stdin"]:
+        return open("/dev/stdin", "rb")
+    dump_handle = open(mediawiki_xml_dump, "rb")
+    if mediawiki_xml_dump.endswith(".gz"):
+        xml_handle = gzip.open(dump_handle, "rb")
     elif mediawiki_xml_dump.endswith(".bz2"):
-        import bz2
+        # Is this a multistream file? With Wikimedia dumps the first stream
+        # holds just the siteinfo, so should find the next one quickly.
+        start = dump_handle.read(1024 * 1024)
+        dump_handle.seek(0)
+        if decompress_threads and bz2_stream_start.search(start, 1):
+            sys.stderr.write(
+                f"Decompressing multistream bz2 with {decompress_threads} threads\n"
+            )
+            return ChunkReader(
+                decompress_bz2_streams(dump_handle, decompress_threads), dump_handle
+            )
+        xml_handle = bz2.open(dump_handle, "rb")
+    else:
+        return dump_handle
+    if decompress_threads:
+        return ChunkReader(read_ahead(xml_handle, decompress_threads), xml_handle)
+    if args.profile or args.stats_json:
+        return TimedReader(xml_handle)
+    return xml_handle
+
+
+# During the initial load revisions are buffered and inserted in batches:
+insert_batch_size = 1000
+upload_batch_bytes = 64 * 1024 * 1024
+pending_revisions = []
+pending_texts = []
+pending_uploads = []
+pending_pages = []
+
+
+def save_revision(title, filename, date, username, text, comment):
+    # Many revisions are identical (e.g. reverts), so the text is stored
+    # once only in its own table, keyed by the SHA1 checksum.
+    if text is None:
+        sha1 = None
+    else:
+        sha1 = hashlib.sha1(text.encode("utf8")).digest()
+        pending_texts.append((sha1, text))
+    pending_revisions.append((title, filename, date, username, sha1, comment))
+    if len(pending_revisions) >= insert_batch_size:
+        flush_revisions()
+
+
+def save_upload(title, filename, date, username, contents, comment):
+    # Uploads are decoded from base64 once here, and the raw bytes stored
+    # once per distinct file in their own table as a BLOB, keyed by SHA1.
+    if contents is None:
+        sha1 = None
+    else:
+        sha1 = hashlib.sha1(contents).digest()
+        pending_uploads.append((sha1, contents))
+    pending_revisions.append((title, filename, date, username, sha1, comment))
+    # Flush sooner if holding lots of large files in memory:
+    if (
+        len(pending_revisions) >= insert_batch_size
+        or sum(len(_[1]) for _ in pending_uploads) >= upload_batch_bytes
+    ):
+        flush_revisions()
 
-        xml_handle = bz2.open(mediawiki_xml_dump, "rb")
+
+def flush_revisions():
+    if sorter:
+        # Using --external-sort instead of SQLite
+        contents = dict(pending_texts)
+        contents.update(pending_uploads)
+        for title, filename, date, username, sha1, comment in pending_revisions:
+            sorter.add(
+                (date, title, filename, username, sha1, comment, contents.get(sha1))
+            )
+        sorter.titles.update(_[0] for _ in pending_pages)
     else:
-        xml_handle = open(mediawiki_xml_dump, "rb")
+        with stage("sqlite_insert", len(pending_revisions)):
+            c.executemany("INSERT OR IGNORE INTO texts VALUES (?, ?)", pending_texts)
+            c.executemany(
+                "INSERT OR IGNORE INTO uploads VALUES (?, ?)", pending_uploads
+            )
+            c.executemany(
+                "INSERT OR IGNORE INTO pages VALUES (?, ?, ?, ?)", pending_pages
+            )
+            c.executemany(
+                "INSERT INTO revisions VALUES (?, ?, ?, ?, ?, ?)", pending_revisions
+            )
+    pending_texts.clear()
+    pending_uploads.clear()
+    pending_pages.clear()
+    pending_revisions.clear()
+
+
+# With --external-sort the revisions are sorted without SQLite. Sorted runs
+# are written to temporary files whenever those held in memory get too big,
+# and merged at the end (so the number of runs is the data size divided by
+# the --sort-memory budget, and memory use while merging stays small).
+sorter = None
+
+
+class ExternalSort:
+    """Sort revision records within a memory budget, using temporary files.
+
+    Records are tuples starting (date, title, ...), which are stored with
+    a running number inserted after the title, so that revisions with the
+    same date and title keep their order from the dump (as with the rowid
+    in the SQLite file).
+    """
+
+    # Most runs to merge at once (each an open file with a read buffer):
+    max_runs = 100
+
+    def __init__(self, budget):
+        self.budget = budget
+        # Removed by close, or when exiting (including on errors or Ctrl-C):
+        self.temp_dir = tempfile.TemporaryDirectory(prefix="xml_to_git_sort_")
+        self.directory = self.temp_dir.name
+        self.records = []
+        self.size = 0  # rough memory use of the records
+        self.count = 0
+        self.runs = []
+        self.count_runs = 0
+        self.disk_size = 0  # of the runs currently on disk
+        self.peak_disk_size = 0
+        self.titles = set()  # of pages with revisions, for the case check
+
+    def add(self, record):
+        self.count += 1
+        self.records.append(record[:2] + (self.count,) + record[2:])
+        # The length of the text or upload, plus an estimate for the rest:
+        self.size += len(record[-1] or "") + 500
+        if self.size >= self.budget:
+            self.write_run()
+
+    def write_run(self, records=None):
+        """Write the records sorted to a new temporary file.
 
+        By default the records in memory, otherwise an iterator of records
+        already in order (from merging earlier runs).
+        """
+        filename = os.path.join(self.directory, "run%i" % self.count_runs)
+        self.count_runs += 1
+        with stage("sort_run", len(self.records)):
+            if records is None:
+                self.records.sort()
+                records = self.records
+            with open(filename, "wb") as handle:
+                for record in records:
+                    pickle.dump(record, handle, pickle.HIGHEST_PROTOCOL)
+        self.runs.append(filename)
+        self.disk_size += os.path.getsize(filename)
+        self.peak_disk_size = max(self.peak_disk_size, self.disk_size)
+        self.records = []
+        self.size = 0
+
+    def finish(self):
+        """Sort the last records, written to disk too unless the only ones."""
+        if self.runs:
+            if self.records:
+                self.write_run()
+            while len(self.runs) > self.max_runs:
+                # Too many to merge at once, so merge the oldest into one
+                runs = self.runs[: self.max_runs]
+                del self.runs[: self.max_runs]
+                self.write_run(self.merge_runs(runs))
+                for filename in runs:
+                    self.disk_size -= os.path.getsize(filename)
+                    os.remove(filename)
+        else:
+            with stage("sort", len(self.records)):
+                self.records.sort()
+
+    def merged(self):
+        """Yield all the records in order, merging any runs from disk."""
+        if not self.runs:
+            # Everything fitted in memory
+            records = self.records
+            self.records = []
+            yield from records
+            return
+        yield from self.merge_runs(self.runs)
+
+    def merge_runs(self, runs):
+        """Yield the records from these runs in order."""
+        buffer_size = max(64 * 1024, self.budget // len(runs))
+        return heapq.merge(*(read_run(_, buffer_size) for _ in runs))
+
+    def close(self):
+        self.temp_dir.cleanup()
+
+
+def read_run(filename, buffer_size=1024 * 1024):
+    """Yield the records from a run written by ExternalSort."""
+    with open(filename, "rb", buffer_size) as handle:
+        while True:
+            try:
+                yield pickle.load(handle)
+            except EOFError:
+                break
+
+
+def parse_pages(xml_handle):
+    """Parse the XML, saving the wanted revisions and uploads to SQLite.
+
+    Returns the number of revisions and uploads saved, and the number
+    skipped as for unwanted pages.
+    """
     usernames = set()
     title = None
     filename = None
@@ -290,20 +1001,55 @@ def parse_xml(mediawiki_xml_dump):
     username = None
     text = None
     revision_count = 0
+    upload_count = 0
+    skipped_count = 0
+    wanted = False
+    start = time.time()
+    dump_size = os.fstat(dump_handle.fileno()).st_size if dump_handle else 0
+    # For the stage timings, the XML parsing is the time in this loop less
+    # any SQLite inserts or decompression done here (not in other threads):
+    nested = ["sqlite_insert", "sort_run"]
+    if not decompress_threads:
+        nested.append("decompression")
+    before = [stage_times.get(_, [0.0, 0.0, 0])[:2] for _ in nested]
+    parse_start = time.perf_counter()
+    parse_cpu = cpu_time()
+    if profiler:
+        profiler.enable()
+    # To keep memory use flat no matter how large the dump (or how many
+    # revisions a page has), we discard each revision/upload once saved
+    # by removing it from its page element, and each page once finished
+    # by clearing it from the root element (which we note from the very
+    # first start event).
+    root = None
+    page_element = None
     e = ElementTree.iterparse(xml_handle, events=("start", "end"))
     for event, element in e:
-        tag = clean_tag(element.tag)
         if event == "start":
+            if root is None:
+                root = element
+                continue
+            tag = element.tag
+            # Skip the start events we don't need before the clean_tag call
+            if not tag.endswith(("page", "revision", "upload")):
+                continue
+            tag = clean_tag(tag)
             if tag == "page":
                 assert title is None, title
                 assert date is None, date
+                page_element = element
+                page_start_count = revision_count + upload_count
             if tag == "revision" or tag == "upload":
                 assert date is None, "%r for %r" % (date, title)
-            if tag == "contents":
-                assert element.attrib["encoding"] == "base64"
-        elif event == "end":
+            continue
+        tag = clean_tag(element.tag)
+        if event == "end":
             if tag == "title":
                 title = element.text.strip()
+                # Decide now so won't keep or decode the contents if unwanted:
+                wanted = page_wanted(title)
+            elif not wanted and tag in ("text", "contents"):
+                element.clear()
             elif tag == "timestamp":
                 date = element.text.strip()
             elif tag == "comment":
@@ -315,7 +1061,8 @@ def parse_xml(mediawiki_xml_dump):
                 text = element.text
             elif tag == "contents":
                 # Used in uploads
-                text = element.text.strip()
+                assert element.attrib["encoding"] == "base64"
+                text = base64.b64decode(element.text)
             elif tag == "filename":
                 # Expected in uploads
                 filename = element.text.strip()
@@ -327,24 +1074,37 @@ def parse_xml(mediawiki_xml_dump):
                 if title.startswith("File:"):
                     # print("Ignoring revision for %s in favour of upload entry" % title)
                     pass
-                elif ignore_by_prefix(title):
+                elif not wanted:
                     # print("Ignoring revision for %s due to title prefix" % title)
-                    pass
+                    skipped_count += 1
                 elif text is not None:
                     # if debug:
                     #     sys.stderr.write(f"Recording '{title}' as of {date} by {username}\n")
-                    c.execute(
-                        "INSERT INTO revisions VALUES (?, ?, ?, ?, ?, ?)",
-                        (title, filename, date, username, text, comment),
-                    )
+                    save_revision(title, filename, date, username, text, comment)
                     revision_count += 1
                     if revision_count % 10000 == 0:
-                        sys.stderr.write(f"DEBUG: {revision_count} revisions so far\n")
-                        conn.commit()
+                        taken = time.time() - start
+                        rate = revision_count / taken
+                        eta = ""
+                        if dump_size:
+                            done = dump_handle.tell() / dump_size
+                            eta = (
+                                f"{done:.0%} of input, "
+                                f"ETA {format_seconds(taken * (1 - done) / done)}, "
+                            )
+                        sys.stderr.write(
+                            f"DEBUG: {revision_count} revisions so far, "
+                            f"{rate:.0f} per second, {eta}"
+                            f"peak memory {peak_memory()}\n"
+                        )
+                        if conn:
+                            conn.commit()
                     if debug and revision_count > 500:
                         sys.stderr.write("DEBUG: That's enough for testing now!\n")
                         break
                 filename = date = username = text = comment = None
+                element.clear()
+                page_element.remove(element)
             elif tag == "upload":
                 assert title.startswith("File:")
                 # Want to treat like a revision?
@@ -352,45 +1112,333 @@ def parse_xml(mediawiki_xml_dump):
                     username = ""
                 if comment is None:
                     comment = ""
-                if text is not None or title.startswith("File:"):
+                if not wanted:
+                    skipped_count += 1
+                elif text is not None or title.startswith("File:"):
                     # print("Recording '%s' as of upload %s by %s" % (title, date, username))
-                    c.execute(
-                        "INSERT INTO revisions VALUES (?, ?, ?, ?, ?, ?)",
-                        (title, filename, date, username, text, comment),
-                    )
+                    save_upload(title, filename, date, username, text, comment)
+                    upload_count += 1
                 filename = date = username = text = comment = None
+                element.clear()
+                page_element.remove(element)
             elif tag == "page":
                 assert date is None, date
+                if revision_count + upload_count > page_start_count:
+                    # Saved something for this page, so add it to the catalog
+                    pending_pages.append(catalog_entry(title))
                 title = filename = date = username = text = comment = None
+                wanted = False
+                page_element = None
+                root.clear()
         else:
             sys.exit("Unexpected event %r with element %r" % (event, element))
+    if profiler:
+        profiler.disable()
+    wall = time.perf_counter() - parse_start
+    cpu = cpu_time() - parse_cpu
+    for name, (nested_wall, nested_cpu) in zip(nested, before):
+        wall -= stage_times.get(name, [0.0, 0.0, 0])[0] - nested_wall
+        cpu -= stage_times.get(name, [0.0, 0.0, 0])[1] - nested_cpu
+    add_stage_time("xml_parse", wall, cpu, revision_count + upload_count)
+    flush_revisions()
+    if conn:
+        conn.commit()
+    return revision_count, upload_count, skipped_count
+
+
+def parse_xml(mediawiki_xml_dump):
+    print("=" * 60)
+    print("Parsing XML and saving revisions by page.")
+    start = time.time()
+    xml_handle = open_dump(mediawiki_xml_dump)
+    counts = parse_pages(xml_handle)
     xml_handle.close()
+    if dump_handle:
+        dump_handle.close()
+    if sorter:
+        # Sort the last of the revisions, merging down any excess runs
+        sorter.finish()
     print("Finished parsing XML and saved revisions by page.")
-    conn.commit()
+    report_parsed(time.time() - start, *counts)
+
+
+def report_parsed(taken, revision_count, upload_count, skipped_count):
+    """Report on the revisions saved, and record any white-list used.
+
+    The time taken is in seconds, including any final sorting.
+    """
+    if sorter:
+        if sorter.runs:
+            how = (
+                f"{stage_times['sort_run'][0]:.2f}s writing {sorter.count_runs} "
+                f"sorted runs, {sorter.peak_disk_size / 1024 / 1024:.1f} MB"
+            )
+        else:
+            how = "sorted in memory"
+        sys.stderr.write(
+            f"Saved {revision_count} revisions and {upload_count} uploads "
+            f"in {taken:.2f}s ({how}), "
+            f"{(revision_count + upload_count) / taken:.0f} rows per second, "
+            f"peak memory {peak_memory()}\n"
+        )
+    else:
+        (count,) = c.execute(
+            "SELECT (SELECT COUNT(*) FROM texts) + (SELECT COUNT(*) FROM uploads)"
+        ).fetchone()
+        sys.stderr.write(
+            f"Saved {revision_count} revisions and {upload_count} uploads "
+            f"({count} distinct) in {taken:.2f}s "
+            f"({stage_times['sqlite_insert'][0]:.2f}s in SQLite inserts), "
+            f"{(revision_count + upload_count) / taken:.0f} rows per second, "
+            f"peak memory {peak_memory()}\n"
+        )
+    if skipped_count:
+        sys.stderr.write(
+            f"Skipped {skipped_count} revisions and uploads of unwanted pages\n"
+        )
+    if page_whitelist and not sorter:
+        # Record this so won't reuse the SQLite file for other pages:
+        c.executemany(
+            "INSERT INTO whitelist VALUES (?)", [(_,) for _ in page_whitelist]
+        )
+        conn.commit()
+
+
+def create_tables():
+    """Create the tables in a new SQLite file, ready for a bulk load."""
+    # Going to use this same table for BOTH plain text revisions to pages
+    # AND for uploads of file attachments, because want to sort both by
+    # date and turn each into a commit. The contents are in separate tables,
+    # stored once per distinct text or (decoded binary) file, keyed by SHA1.
+    c.execute(
+        "CREATE TABLE revisions "
+        "(title text, filename text, date text, username text, sha1 blob, comment text)"
+    )
+    c.execute("CREATE TABLE texts (sha1 blob PRIMARY KEY, content text)")
+    c.execute("CREATE TABLE uploads (sha1 blob PRIMARY KEY, content blob)")
+    # Any white-list of titles used, as only those pages will be saved:
+    c.execute("CREATE TABLE whitelist (title text PRIMARY KEY)")
+    # Catalog of the pages with revisions or uploads, see catalog_entry:
+    c.execute(
+        "CREATE TABLE pages "
+        "(title text PRIMARY KEY, namespace text, name text, fold text)"
+    )
+    # Bulk load settings. This file is only a cache which we would rebuild
+    # from scratch if interrupted, so can skip the journal and syncing:
+    c.execute("PRAGMA journal_mode = OFF")
+    c.execute("PRAGMA synchronous = OFF")
+    c.execute("PRAGMA cache_size = -65536")  # in KiB, so 64MB
+
+
+# With --ingest-jobs the XML is split into ranges of whole pages, each parsed
+# by a worker process into its own SQLite shard, which are then merged in
+# order (so the revisions get the same rowid as when parsed in one go).
+xml_root_tag = re.compile(rb"<mediawiki\b[^>]*>")
+xml_page_tag = b"<page>"
+
+
+def split_pages(filename, jobs, chunk_size=1024 * 1024):
+    """Return list of (start, end) byte ranges, split at <page> tags."""
+    size = os.path.getsize(filename)
+    offsets = [0]
+    with open(filename, "rb") as handle:
+        for i in range(1, jobs):
+            offset = max(size * i // jobs, offsets[-1] + 1)
+            handle.seek(offset)
+            found = -1
+            data = b""
+            while found < 0:
+                more = handle.read(chunk_size)
+                if not more:
+                    break
+                # Keep the end of the previous chunk in case split the tag:
+                data = data[-len(xml_page_tag) :] + more
+                found = data.find(xml_page_tag)
+                offset += len(more)
+            if found < 0:
+                # No more pages
+                break
+            offsets.append(offset - len(data) + found)
+    offsets.append(size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def read_range(handle, start, end, header, footer, chunk_size=1024 * 1024):
+    """Yield the header, the bytes from start to end of the file, and footer."""
+    yield header
+    handle.seek(start)
+    while start < end:
+        data = handle.read(min(chunk_size, end - start))
+        if not data:
+            break
+        start += len(data)
+        yield data
+    yield footer
+
+
+def parse_shard(filename, start, end, header, footer, shard):
+    """Parse a range of pages from the XML file into a new SQLite shard.
+
+    Run in a worker process (forked, so has a copy of our globals). Returns
+    the counts from parse_pages, and the stage timings.
+    """
+    global conn, c, dump_handle, profiler
+    stage_times.clear()
+    dump_handle = None  # no progress estimates from the workers
+    profiler = None
+    if os.path.isfile(shard):
+        os.remove(shard)
+    # Don't touch the parent's SQLite connection, make our own:
+    conn = sqlite3.connect(shard)
+    c = conn.cursor()
+    create_tables()
+    handle = open(filename, "rb")
+    xml_handle = ChunkReader(read_range(handle, start, end, header, footer), handle)
+    counts = parse_pages(xml_handle)
+    xml_handle.close()
+    conn.close()
+    return counts, stage_times
+
+
+def merge_shard(shard):
+    """Append the contents of a SQLite shard to our tables, and remove it."""
+    with stage("sqlite_merge"):
+        c.execute("ATTACH DATABASE ? AS shard", (shard,))
+        c.execute("INSERT INTO revisions SELECT * FROM shard.revisions ORDER BY rowid")
+        for table in ("texts", "uploads", "pages"):
+            c.execute(
+                f"INSERT OR IGNORE INTO {table} "
+                f"SELECT * FROM shard.{table} ORDER BY rowid"
+            )
+        conn.commit()
+        c.execute("DETACH DATABASE shard")
+    os.remove(shard)
+
+
+def parse_xml_sharded(mediawiki_xml_dump, jobs):
+    print("=" * 60)
+    print(f"Parsing XML and saving revisions by page using {jobs} processes.")
+    if "fork" not in multiprocessing.get_all_start_methods():
+        sys.exit("ERROR: Option --ingest-jobs is not supported on this platform")
+    start = time.time()
+    # The temporary files (any decompressed XML, and the shards) are removed
+    # even if a worker fails or we are interrupted:
+    with tempfile.TemporaryDirectory(prefix="xml_to_git_ingest_") as temp_dir:
+        filename = mediawiki_xml_dump
+        if mediawiki_xml_dump in ["-", "/dev/stdin"] or mediawiki_xml_dump.endswith(
+            (".gz", ".bz2")
+        ):
+            # Need to seek within the uncompressed XML
+            filename = os.path.join(temp_dir, "dump.xml")
+            sys.stderr.write(f"Decompressing to temporary file {filename}\n")
+            xml_handle = open_dump(mediawiki_xml_dump)
+            with stage("xml_copy"):
+                with open(filename, "wb") as handle:
+                    shutil.copyfileobj(xml_handle, handle, 1024 * 1024)
+            xml_handle.close()
+            if dump_handle:
+                dump_handle.close()
+        with open(filename, "rb") as handle:
+            match = xml_root_tag.search(handle.read(1024 * 1024))
+        if not match:
+            sys.exit(f"ERROR: Could not find <mediawiki> root tag in {filename}")
+        header = match.group()
+        footer = b"</mediawiki>"
+        ranges = split_pages(filename, jobs)
+        shards = [
+            os.path.join(temp_dir, f"shard{i}.sqlite") for i in range(len(ranges))
+        ]
+        context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(jobs, mp_context=context) as pool:
+            futures = [
+                pool.submit(
+                    parse_shard,
+                    filename,
+                    range_start,
+                    range_end,
+                    header if i else b"",
+                    footer if i < len(ranges) - 1 else b"",
+                    shard,
+                )
+                for i, ((range_start, range_end), shard) in enumerate(
+                    zip(ranges, shards)
+                )
+            ]
+            totals = [0, 0, 0]
+            # Merge in order as each finishes
+            for future, shard in zip(futures, shards):
+                counts, times = future.result()
+                totals = [a + b for a, b in zip(totals, counts)]
+                for name, (wall, cpu, count) in times.items():
+                    add_stage_time(name, wall, cpu, count)
+                merge_shard(shard)
+    print("Finished parsing XML and saved revisions by page.")
+    report_parsed(time.time() - start, *totals)
+
+
+# Increase this when changing the schema, so older files get rebuilt:
+sqlite_format = 6
+
+
+def sqlite_file_format(db):
+    """Return the schema version recorded in the SQLite file."""
+    conn = sqlite3.connect(db)
+    (version,) = conn.execute("PRAGMA user_version").fetchone()
+    conn.close()
+    return version
+
+
+def sqlite_file_whitelist(db):
+    """Return the white-list of titles the SQLite file was made with, or None."""
+    conn = sqlite3.connect(db)
+    titles = {_ for (_,) in conn.execute("SELECT title FROM whitelist")}
+    conn.close()
+    return titles or None
+
+
+def sqlite_file_reusable(db):
+    """Does the SQLite file have everything this run needs?"""
+    if sqlite_file_format(db) != sqlite_format:
+        return False
+    titles = sqlite_file_whitelist(db)
+    if titles is not None and not (page_whitelist and page_whitelist <= titles):
+        sys.stderr.write(f"SQLite file {db} only has some of the pages wanted\n")
+        return False
+    return True
 
 
 db = mediawiki_xml_dump + ".sqlite"
 if mediawiki_xml_dump in ["-", "/dev/stdin"]:
     db = "stdin.sqlite"
 
-if (
+if args.external_sort:
+    if ingest_jobs > 1:
+        sys.exit("ERROR: Option --ingest-jobs is not supported with --external-sort")
+    conn = c = None
+    sorter = ExternalSort(args.sort_memory * 1024 * 1024)
+    parse_xml(mediawiki_xml_dump)
+
+elif (
     db != "stdin.sqlite"
     and os.path.isfile(db)
     and os.stat(mediawiki_xml_dump).st_mtime < os.stat(db).st_mtime
+    and sqlite_file_reusable(db)
 ):
     sys.stderr.write(f"Checking SQLite file {db}\n")
     conn = sqlite3.connect(db)
     c = conn.cursor()
-    (count,) = c.execute("SELECT COUNT(*) FROM revisions;").fetchone()
-    if not count:
-        sys.exit(f"SQLite file {db} has no revisions\n")
-    sys.stderr.write(f"SQLite file {db} has {count} revisions\n")
+    # The index is only made once the load has finished, so check this first
+    # as a partial file from an interrupted bulk load may not be readable:
     (count,) = c.execute(
         "SELECT COUNT(*) FROM sqlite_master WHERE type='index' "
         "AND tbl_name='revisions' and name='idx_date_title';"
     ).fetchone()
     if not count:
         sys.exit(f"Can't reuse partial SQLite file {db} - missing index")
+    (count,) = c.execute("SELECT COUNT(*) FROM revisions;").fetchone()
+    if not count:
+        sys.exit(f"SQLite file {db} has no revisions\n")
+    sys.stderr.write(f"SQLite file {db} has {count} revisions\n")
 
 else:
     sys.stderr.write(f"Creating SQLite file {db}\n")
@@ -402,36 +1450,359 @@ else:
 
     conn = sqlite3.connect(db)
     c = conn.cursor()
-    # Going to use this same table for BOTH plain text revisions to pages
-    # AND for base64 encoded uploads for file attachments, because want
-    # to sort both by date and turn each into a commit.
+    create_tables()
+    if ingest_jobs > 1:
+        parse_xml_sharded(mediawiki_xml_dump, ingest_jobs)
+    else:
+        parse_xml(mediawiki_xml_dump)
+    # Much faster to build the indexes once all the data is loaded:
+    start = time.time()
+    with stage("sqlite_index"):
+        # Gives the commit order, as the rowid is implicitly the last column
+        # (so no sorting needed for ORDER BY date, title, rowid):
+        c.execute("CREATE INDEX idx_date_title ON revisions(date, title);")
+        c.execute("CREATE INDEX idx_pages_namespace ON pages(namespace);")
+        c.execute("CREATE INDEX idx_pages_fold ON pages(fold);")
+        c.execute(f"PRAGMA user_version = {sqlite_format}")
+        conn.commit()
+    sys.stderr.write(f"Indexed SQLite file in {time.time() - start:.2f}s\n")
+    c.execute("PRAGMA journal_mode = DELETE")
+    c.execute("PRAGMA synchronous = FULL")
+    sys.stderr.write(f"Created SQLite file {db}\n")
+
+
+# Progress of the commit loop is recorded in the SQLite file, as the
+# key of the last revision committed, and the git commit it produced.
+# This allows resuming if the script is interrupted (as long as the
+# same command line options are used).
+already_committed = deque()  # of (git commit, author date) pairs
+resumed_commit = None
+commits_since_checkpoint = 0
+progress_commit = None
+
+
+git_hash = re.compile("[0-9a-f]{40}([0-9a-f]{24})?$")
+
+
+def head_commit():
+    """Return the commit of HEAD, or an empty string for a new repository.
+
+    Called after every commit without --fast-import, so where possible
+    reads this from the .git folder rather than running git rev-parse
+    (falling back on that for packed refs, reftables, etc).
+    """
+    try:
+        with open(os.path.join(".git", "HEAD")) as handle:
+            head = handle.read().strip()
+        if head.startswith("ref: "):
+            with open(os.path.join(".git", head[5:])) as handle:
+                head = handle.read().strip()
+        if git_hash.match(head):
+            return head
+    except OSError:
+        pass
+    return git_output([git, "rev-parse", "--verify", "-q", "HEAD"]) or ""
+
+
+def load_progress():
+    """Return (date, title, rowid) key to resume after, or None for the start.
+
+    Also sets up already_committed if the branch got ahead of the record,
+    i.e. we were interrupted after git updated the branch but before the
+    progress was saved.
+    """
     c.execute(
-        "CREATE TABLE revisions "
-        "(title text, filename text, date text, username text, content text, comment text)"
+        "CREATE TABLE IF NOT EXISTS progress "
+        "(start text, date text, title text, rowid integer, git_commit text)"
     )
-    parse_xml(mediawiki_xml_dump)
-    c.execute("CREATE INDEX idx_date_title ON revisions(date, title);")
+    head = head_commit()
+    row = c.execute(
+        "SELECT start, date, title, rowid, git_commit FROM progress"
+    ).fetchone()
+    if row is not None and not restart:
+        start, date, title, rowid, done = row
+        if head == (done or start):
+            if done:
+                sys.stderr.write(f"Resuming after {date} {title} ({done})\n")
+                return date, title, rowid
+            return None
+        if done and head:
+            # Are there commits on the branch since the recorded one?
+            commits = git_output(
+                [git, "log", "--reverse", "--format=%H %at", f"{done}..{head}"]
+            )
+            if (
+                commits
+                and git_output([git, "merge-base", "--is-ancestor", done, head])
+                is not None
+            ):
+                for line in commits.split("\n"):
+                    commit, author_date = line.split()
+                    already_committed.append((commit, int(author_date)))
+                sys.stderr.write(
+                    f"Resuming after {date} {title} ({done}), "
+                    f"with {len(already_committed)} later commits already done\n"
+                )
+                return date, title, rowid
+        if head != start:
+            sys.exit(
+                f"ERROR: Current HEAD {head} does not match the progress recorded "
+                f"in {db}, reset your branch to {done or start}, or use --restart"
+            )
+    c.execute("DELETE FROM progress")
+    c.execute("INSERT INTO progress (start) VALUES (?)", (head,))
     conn.commit()
-    sys.stderr.write(f"Created SQLite file {db}\n")
+    return None
 
 
-def commit_file(title, filename, date, username, contents, comment):
-    # commit an image or other file from its base64 encoded representation
+def save_progress(date, title, rowid, final=False, changed=True):
+    """Record this revision has been committed (may be deferred).
+
+    Use changed=False for a revision skipped as it would not change the file.
+    """
+    global commits_since_checkpoint, resumed_commit, progress_commit
+    if sorter:
+        # Nothing kept to resume from with --external-sort
+        return
+    if resumed_commit:
+        commit = resumed_commit
+        resumed_commit = None
+    elif fast_import:
+        if changed:
+            commits_since_checkpoint += 1
+        if commits_since_checkpoint < checkpoint_every and not final:
+            return
+        commit = fast_import_checkpoint()
+    elif not changed and progress_commit:
+        # Nothing was committed, so the branch is where it was
+        commit = progress_commit
+    else:
+        with stage("read_head"):
+            commit = head_commit()
+    commits_since_checkpoint = 0
+    progress_commit = commit
+    with stage("save_progress"):
+        c.execute(
+            "UPDATE progress SET date=?, title=?, rowid=?, git_commit=?",
+            (date, title, rowid, commit),
+        )
+        conn.commit()
+
+
+def upload_chunks(rowid, chunk_size=1024 * 1024):
+    """Yield the contents of an upload from the SQLite file in chunks.
+
+    Uses incremental BLOB I/O where available (Python 3.11 onwards), so
+    large uploads need not be held in memory at once. Otherwise the
+    contents are fetched in one go (rather than using substr, which would
+    load the whole BLOB again for every chunk).
+    """
+    if not hasattr(conn, "blobopen"):
+        (content,) = conn.execute(
+            "SELECT content FROM uploads WHERE rowid = ?", (rowid,)
+        ).fetchone()
+        yield content
+        return
+    with conn.blobopen("uploads", "content", rowid, readonly=True) as blob:
+        while True:
+            chunk = blob.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def page_text(sha1):
+    """Return the text of a page revision from the SQLite file."""
+    (text,) = conn.execute(
+        "SELECT content FROM texts WHERE sha1 = ?", (sha1,)
+    ).fetchone()
+    return text
+
+
+def commit_file(title, filename, date, username, sha1, comment, contents=None):
+    # commit an image or other file, read from the SQLite file unless
+    # given the contents (from --external-sort)
     assert username not in blocklist
     assert title.startswith("File:")
-    if not filename:
-        filename = os.path.join(
-            prefix, make_cannonical(title[5:])
-        )  # should already have extension
     print("Commit %s %s by %s : %s" % (date, filename, username, comment[:40]))
-    with open(filename, "wb") as handle:
-        handle.write(base64.b64decode(contents))
-    commit_files([filename], username, date, comment)
+    if contents is not None:
+        commit_contents(filename, contents, username, date, comment)
+        return
+    rowid, size = conn.execute(
+        "SELECT rowid, length(content) FROM uploads WHERE sha1 = ?", (sha1,)
+    ).fetchone()
+    commit_contents(filename, upload_chunks(rowid), username, date, comment, size=size)
+
+
+# With --markdown, the page revisions are converted using the functions
+# from mediawiki_to_md.py (which must be next to this script):
+md = None
+if args.markdown:
+    import mediawiki_to_md as md
+
+    md.init_worker(
+        md.parser.parse_args(
+            [
+                "--input",
+                ".",
+                "--prefix",
+                prefix,
+                "--mediawiki-ext",
+                mediawiki_ext,
+                "--markdown-ext",
+                markdown_ext,
+            ]
+        ),
+        md.check_pandoc(),
+        {},
+        {},
+    )
+
+# Number of revisions per batch sent to the --markdown worker processes,
+# and how many converted revisions to remember for when a text reappears
+# (e.g. reverting vandalism):
+markdown_batch_size = 20
+markdown_memo_size = 10000
+
+
+def markdown_batch(pages):
+    """Convert a batch of page revisions to Markdown.
+
+    Run in the --markdown worker processes (forked, so already have the
+    mediawiki_to_md settings). Takes (MediaWiki filename, title, text)
+    tuples, the filename only being used in any pandoc error messages as
+    nothing is written here. Returns a list of (Markdown, warnings),
+    and the stage timings for the batch. Redirects become pages
+    redirecting to the target, as mediawiki_to_md.py's redirect_from
+    entries depend on the final state of the wiki.
+    """
+    stage_times.clear()
+    results = [None] * len(pages)
+    todo = []
+    for i, (mw_filename, title, text) in enumerate(pages):
+        with stage("cleanup_mediawiki"):
+            text, categories, title = md.cleanup_mediawiki(
+                "---\ntitle: %s\n---\n\n%s" % (title, text)
+            )
+        redirect, external = md.find_redirect(text)
+        if redirect:
+            if not external:
+                redirect = md.make_url(redirect)
+            results[i] = (md.redirect_page(title, redirect), "")
+        else:
+            todo.append(i)
+            pages[i] = (mw_filename, text, categories, title)
+    if todo:
+        try:
+            converted = md.convert_batch([pages[i] for i in todo])
+        except SystemExit:
+            # Calling pandoc failed, try one by one to find which
+            converted = [markdown_fallback(pages[i]) for i in todo]
+        for i, (markdown, warnings, how) in zip(todo, converted):
+            results[i] = (markdown, warnings)
+    return results, stage_times
+
+
+def markdown_fallback(page):
+    """Convert a single page revision, or if pandoc fails use it unconverted.
+
+    A historical revision which pandoc can't handle should not stop the
+    import, so this commits the cleaned up MediaWiki text with our header.
+    """
+    try:
+        return md.convert_batch([page])[0]
+    except SystemExit as err:
+        mw_filename, text, categories, title = page
+        warnings = f"{err}\nWARNING - committing a revision of {title} unconverted\n"
+        return md.make_header(title, categories) + text, warnings, "failed"
+
+
+def convert_rows(rows):
+    """Yield the revision rows in order, with the page texts as Markdown.
+
+    A pool of --jobs worker processes converts batches of the revisions,
+    keeping a limited number of batches ahead of the caller (which makes
+    the commits, in the original order). A text seen again for the same
+    page (e.g. a revert) is only converted once.
+    """
+    memo = OrderedDict()  # (title, sha1) to [future, index in its batch]
+    pending = deque()  # batches of (row, memo entry, first use) in order
+    batch = []
+    pages = []
+    slots = []
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max(1, args.jobs), mp_context=context) as pool:
+        for row in rows:
+            namespace, sha1 = row[2], row[7]
+            if sha1 is None or namespace == "File":
+                # Not converting these
+                batch.append((row, None, False))
+                continue
+            key = (row[1], sha1)
+            slot = memo.get(key)
+            if slot:
+                memo.move_to_end(key)
+                batch.append((row, slot, False))
+                continue
+            slot = memo[key] = [None, len(pages)]
+            if len(memo) > markdown_memo_size:
+                memo.popitem(last=False)
+            text = row[9] if row[9] is not None else page_text(sha1)
+            mw_filename = os.path.join(prefix, row[3] + os.path.extsep + mediawiki_ext)
+            pages.append((mw_filename, row[1], text))
+            slots.append(slot)
+            batch.append((row, slot, True))
+            if len(pages) >= markdown_batch_size:
+                future = pool.submit(markdown_batch, pages)
+                for slot in slots:
+                    slot[0] = future
+                pending.append(batch)
+                batch, pages, slots = [], [], []
+                if len(pending) >= 4 * args.jobs:
+                    yield from converted_rows(pending.popleft())
+        if pages:
+            future = pool.submit(markdown_batch, pages)
+            for slot in slots:
+                slot[0] = future
+        pending.append(batch)
+        while pending:
+            yield from converted_rows(pending.popleft())
 
 
+def converted_rows(batch):
+    """Yield the rows in a batch from convert_rows, with the Markdown."""
+    for row, slot, first in batch:
+        if slot is None:
+            yield row
+            continue
+        future, index = slot
+        with stage("markdown_wait"):
+            results, times = future.result()
+        if first and index == 0:
+            # Only add up the worker's timings once per batch:
+            for name, (wall, cpu, count) in times.items():
+                add_stage_time(name, wall, cpu, count)
+        markdown, warnings = results[index]
+        if first and warnings:
+            sys.stderr.write(warnings)
+        yield row[:9] + (markdown,)
+
+
+# The white-list and the namespaces to ignore are applied in SQL using the
+# pages table, with the white-list (if any) in a temporary table:
+# (We can't handle templates properly yet, so those are skipped too.)
+assert all(_.endswith(":") and ":" not in _[:-1] for _ in page_prefixes_to_ignore)
+page_filter_args = [_[:-1] for _ in page_prefixes_to_ignore] + ["Template"]
+page_filter = "p.namespace NOT IN (%s)" % ", ".join("?" * len(page_filter_args))
+if page_whitelist and not sorter:
+    c.execute("CREATE TEMP TABLE wanted (title text PRIMARY KEY)")
+    c.executemany("INSERT INTO wanted VALUES (?)", [(_,) for _ in page_whitelist])
+    conn.commit()
+    page_filter += " AND p.title IN (SELECT title FROM temp.wanted)"
+
 CASE_SENSITIVE = False
 try:
-    os.lstat(db.upper())
+    os.lstat((".git" if sorter else db).upper())
 except IOError as e:
     import errno
 
@@ -441,77 +1812,281 @@ if not CASE_SENSITIVE:
     sys.stderr.write("WARNING: File system is case insensitive - a potential issue.\n")
     # print("=" * 60)
     # print("Checking for potential name clashes")
-    names = dict()
-    # This will be slow with a large DB!
-    for (title,) in c.execute("SELECT DISTINCT title FROM revisions ORDER BY title"):
-        if page_whitelist and title not in page_whitelist:
-            continue
-        if ignore_by_prefix(title):
-            assert False, "Should have already excluded %s?" % title
-            pass
-        elif title.lower() not in names:
-            names[title.lower()] = title
-        else:
-            if names[title.lower()] != title:
-                print("WARNING: Multiple case variants exist, e.g.")
-                print(" - " + title)
-                print(" - " + names[title.lower()])
-                print(
-                    "If your file system cannot support such filenames at the same time"
-                )
-                print("(e.g. Windows, or default Mac OS X) this conversion will FAIL.")
-                # sys.exit(
-                #    "ERROR: Mixed case files found, but file system insensitive"
-                # )  # needs a --force option or something?
+    if sorter:
+        folds = {}
+        for title in sorter.titles:
+            title, namespace, name, fold = catalog_entry(title)
+            if namespace not in page_filter_args:
+                folds.setdefault(fold, []).append(title)
+        clashes = [folds[_] for _ in sorted(folds) if len(folds[_]) > 1]
+    else:
+        clashes = [
+            titles.split("\n")
+            for (titles,) in c.execute(
+                "SELECT group_concat(title, char(10)) FROM pages p WHERE "
+                + page_filter
+                + " GROUP BY fold HAVING COUNT(*) > 1 ORDER BY fold",
+                page_filter_args,
+            ).fetchall()
+        ]
+    for titles in clashes:
+        print("WARNING: Multiple case variants exist, e.g.")
+        for title in sorted(titles):
+            print(" - " + title)
+        print("If your file system cannot support such filenames at the same time")
+        print("(e.g. Windows, or default Mac OS X) this conversion will FAIL.")
+        # sys.exit(
+        #    "ERROR: Mixed case files found, but file system insensitive"
+        # )  # needs a --force option or something?
 
 print("=" * 60)
 print("Sorting changes by revision date...")
-for title, filename, date, username, text, comment in c.execute(
-    "SELECT * FROM revisions ORDER BY date, title"
-):
-    if filename:
-        filename = os.path.join(prefix, filename)
+
+
+def sorted_rows():
+    """Yield the revisions from --external-sort as rows like the SQL query.
+
+    That is with the page catalog entries, skipping the namespaces to ignore
+    (the white-list was already applied while parsing), and with the text or
+    upload contents at the end.
+    """
+    for record in sorter.merged():
+        date, title, number, filename, username, sha1, comment, contents = record
+        title, namespace, name, fold = catalog_entry(title)
+        if namespace in page_filter_args:
+            continue
+        yield (
+            number,
+            title,
+            namespace,
+            name,
+            filename,
+            date,
+            username,
+            sha1,
+            comment,
+            contents,
+        )
+
+
+def page_filename(name):
+    """Filename within the git repository for a page (not an upload)."""
+    return os.path.join(
+        prefix, name + os.path.extsep + (markdown_ext if md else mediawiki_ext)
+    )
+
+
+def load_committed(resume_key):
+    """Return the committed_sha1 entries as of resuming after this revision.
+
+    Replays the metadata of the revisions up to and including the resume
+    key, so a resumed run skips the same revisions as a straight run would.
+    """
+    committed = {}
+    for title, namespace, name, filename, username, sha1 in conn.execute(
+        "SELECT r.title, p.namespace, p.name, r.filename, r.username, r.sha1 "
+        "FROM revisions r JOIN pages p ON r.title = p.title WHERE "
+        + page_filter
+        + " AND (r.date, r.title, r.rowid) <= (?, ?, ?)"
+        " ORDER BY r.date, r.title, r.rowid",
+        page_filter_args + list(resume_key),
+    ):
+        if namespace != "File":
+            committed[page_filename(name)] = (title, sha1)
+        elif username not in blocklist:
+            committed[os.path.join(prefix, filename or name)] = sha1
+    return committed
+
+
+if sorter:
+    resume_key = None
+    if use_fast_import:
+        start_fast_import()
+    revisions = sorted_rows()
+    total_rows = sorter.count
+else:
+    # Progress is updated after each commit, so want cheap writes from now on:
+    c.execute("PRAGMA journal_mode = WAL")
+    c.execute("PRAGMA synchronous = NORMAL")
+    resume_key = load_progress()
+    if use_fast_import:
+        start_fast_import()
+    # Only the metadata is read here, in order using the index. The texts
+    # are fetched when actually needed (see commit_page and convert_rows):
+    revisions_from = (
+        "FROM revisions r JOIN pages p ON r.title = p.title WHERE " + page_filter
+    )
+    revisions_args = page_filter_args
+    if resume_key:
+        revisions_from += " AND (r.date, r.title, r.rowid) > (?, ?, ?)"
+        revisions_args = page_filter_args + list(resume_key)
+    # Adding a placeholder for the text, which commit_page will fetch
+    revisions = (
+        row + (None,)
+        for row in conn.execute(
+            "SELECT r.rowid, r.title, p.namespace, p.name, r.filename, r.date, "
+            "r.username, r.sha1, r.comment "
+            + revisions_from
+            + " ORDER BY r.date, r.title, r.rowid",
+            revisions_args,
+        )
+    )
+    if args.profile:
+        (total_rows,) = conn.execute(
+            "SELECT COUNT(*) " + revisions_from, revisions_args
+        ).fetchone()
+
+
+def commit_page(rowid, title, mw_filename, date, username, text, comments, sha1):
+    """Commit a revision of a page (possibly squashed), and record progress.
+
+    Skipped if the text is the same as last committed for this page (the
+    title is checked too as it goes in the header, and several titles
+    could give the same filename).
+    """
+    global commit_count, unwanted_commits, unchanged_revisions
+    if committed_sha1.get(mw_filename) == (title, sha1):
+        unchanged_revisions += 1
+        save_progress(date, title, rowid, changed=False)
+        return
+    committed_sha1[mw_filename] = (title, sha1)
     if text is None:
-        assert title.startswith("File:"), date
-    # assert text is not None, date
-    if page_whitelist and title not in page_whitelist:
-        # Not wanted, ignore
-        # print("Ignoring: %s" % title)
-        continue
-    if ignore_by_prefix(title):
-        # Not interesting, ignore
-        continue
-    if title.startswith("File:"):
-        # Example Title File:Wininst.png
-        # TODO - capture the preferred filename from the XML!
-        if username in blocklist:
-            sys.stderr.write(f"Ignoring upload {filename} from {username}\n")
-        commit_file(title, filename, date, username, text, comment)
-        continue
-    if title.startswith("Template:"):
-        # Can't handle these properly (yet)
-        continue
-    # if title.startswith("Category:"):
-    #     # TODO - may need to insert some Jekyll template magic?
-    #     # See https://github.com/peterjc/mediawiki_to_git_md/issues/6
-    assert filename is None
-    mw_filename = make_filename(title, mediawiki_ext)
+        text = page_text(sha1)
     if username in blocklist:
         unwanted_commits += 1
         comment = f"UNWANTED FROM {username}"
         print(f"UNWANTED {date} {mw_filename} by {username}")
     else:
+        comment = "\n".join(comments)
         print(f"Commit {date} {mw_filename} by {username}")
     if not comment:
         comment = f"Update {title}"
-    with open(mw_filename, "w") as handle:
+    if not md:
         # We need to record the page title somewhere
         # Might as well use a Markdown style header block:
-        handle.write("---\n")
-        handle.write("title: %s\n" % title)
-        handle.write("---\n\n")
-        handle.write(text)
-    commit_files([mw_filename], username, date, comment)
+        text = "---\ntitle: %s\n---\n\n%s" % (title, text)
+    commit_contents(mw_filename, text.encode("utf8"), username, date, comment)
+    save_progress(date, title, rowid)
+    commit_count += 1
+
+
+def can_squash(pending, title, username, date, comment):
+    """Can this revision be squashed into the pending one (see --squash-minutes)?"""
+    if not pending or not squash_seconds:
+        return False
+    if pending[1] != title or pending[4] != username:
+        return False
+    if parse_date(date) - pending_start > squash_seconds:
+        return False
+    return (
+        args.squash_any_comment
+        or not comment
+        or not pending[6]
+        or pending[6] == [comment]
+    )
+
+
+# With --squash-minutes, the latest page revision is held back here (as
+# the arguments for commit_page) in case the next revision can be squashed
+# into it, and pending_start is the date of the first revision in the series.
+pending = None
+pending_start = None
+# Checksum of the upload, or the title and checksum of the text, last
+# committed to each file, used to skip revisions which would not change
+# it (e.g. null edits, or re-uploads):
+committed_sha1 = load_committed(resume_key) if resume_key else {}
+unchanged_revisions = 0
+commit_count = 0
+row_count = 0
+start = time.time()
+loop_cpu = cpu_time()
+if md:
+    revisions = convert_rows(revisions)
+if profiler:
+    profiler.enable()
+for (
+    rowid,
+    title,
+    namespace,
+    name,
+    filename,
+    date,
+    username,
+    sha1,
+    comment,
+    text,
+) in revisions:
+    row_count += 1
+    if args.profile and row_count % 1000 == 0:
+        taken = time.time() - start
+        sys.stderr.write(
+            f"Progress: {row_count} of {total_rows} revisions, "
+            f"{commit_count / taken:.0f} commits per second, ETA "
+            f"{format_seconds(taken * (total_rows - row_count) / row_count)}, "
+            f"peak memory {peak_memory()}\n"
+        )
+    # Any white-list and ignored prefixes were applied in the SQL query
+    # (or by sorted_rows)
+    if sha1 is None:
+        assert namespace == "File", date
+    if namespace == "File":
+        # Example Title File:Wininst.png
+        # Use the preferred filename from the XML if given:
+        filename = os.path.join(prefix, filename or name)
+        if username in blocklist:
+            sys.stderr.write(f"Ignoring upload {filename} from {username}\n")
+            continue
+        if pending:
+            commit_page(*pending)
+            pending = None
+        if committed_sha1.get(filename) == sha1:
+            unchanged_revisions += 1
+            save_progress(date, title, rowid, changed=False)
+            continue
+        committed_sha1[filename] = sha1
+        commit_file(title, filename, date, username, sha1, comment, text)
+        save_progress(date, title, rowid)
+        commit_count += 1
+        continue
+    # if title.startswith("Category:"):
+    #     # TODO - may need to insert some Jekyll template magic?
+    #     # See https://github.com/peterjc/mediawiki_to_git_md/issues/6
+    assert filename is None
+    mw_filename = page_filename(name)
+    if can_squash(pending, title, username, date, comment):
+        squashed_revisions += 1
+        comments = pending[6]
+        if comment and comment not in comments:
+            comments.append(comment)
+        pending = (rowid, title, mw_filename, date, username, text, comments, sha1)
+        continue
+    if pending:
+        commit_page(*pending)
+        pending = None
+    comments = [comment] if comment else []
+    if squash_seconds:
+        pending = (rowid, title, mw_filename, date, username, text, comments, sha1)
+        pending_start = parse_date(date)
+    else:
+        commit_page(rowid, title, mw_filename, date, username, text, comments, sha1)
+if pending:
+    commit_page(*pending)
+if row_count:
+    # Record the final position, even if the last revisions were skipped
+    save_progress(date, title, rowid, final=True, changed=False)
+
+if fast_import:
+    finish_fast_import()
+if sorter:
+    sorter.close()
+if profiler:
+    profiler.disable()
+taken = max(time.time() - start, 0.001)
+add_stage_time("commit_loop", taken, cpu_time() - loop_cpu, commit_count)
+sys.stderr.write(
+    f"Made {commit_count} commits in {taken:.2f}s, "
+    f"{commit_count / taken:.0f} per second, peak memory {peak_memory()}\n"
+)
 
 print("=" * 60)
 if missing_users:
@@ -520,4 +2095,28 @@ if missing_users:
         print("%i - %s" % (missing_users[username], username))
 
 print(f"There are {unwanted_commits} unwanted commits from blocked users.")
+if squash_seconds:
+    print(f"Squashed {squashed_revisions} revisions into earlier commits.")
+print(f"Skipped {unchanged_revisions} revisions which did not change the file.")
+if args.profile or args.stats_json:
+    counts = {
+        "commits": commit_count,
+        "unwanted_commits": unwanted_commits,
+        "squashed_revisions": squashed_revisions,
+        "unchanged_revisions": unchanged_revisions,
+    }
+    if sorter:
+        counts["sort_runs"] = sorter.count_runs
+        counts["sort_disk_bytes"] = sorter.peak_disk_size
+    report_stages(
+        "xml_to_git.py",
+        __version__,
+        args,
+        time.perf_counter() - script_start,
+        cpu_time() - script_cpu,
+        counts,
+    )
+if profiler:
+    print("=" * 60)
+    pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
 print("Done")